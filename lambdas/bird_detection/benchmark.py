@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Offline CPU benchmark of image_prediction and video_prediction.
+# Usage: python benchmark.py [--quick] [--output results.json] [--baseline old.json] [--model model.pt]
+#
+# Runs on generated data only: synthetic images and videos with a given number
+# of bird-like blobs at several resolutions and lengths, and, unless --model is
+# given, an untrained yolov8n checkpoint built from its config with a fixed
+# seed. Detections from that model are meaningless, its speed is not. The
+# model is served through BUNDLED_MODEL_DIR, so nothing is read from S3.
+#
+# Every case reports frames/sec, p50/p95 per-frame latency and peak RSS, the
+# run reports model load time. Results go to a JSON file tagged with the git
+# commit; --baseline prints the fps change against an earlier results file.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+DATA_DIR = os.environ.get('BENCHMARK_DATA_DIR', '/tmp/birdtag_benchmark')
+SEED = 0
+
+# (width, height), number of birds
+IMAGE_CASES = [((w, h), birds) for w, h in [(640, 480), (1280, 720), (1920, 1080)] for birds in [0, 3, 12]]
+# (width, height), seconds, number of birds
+VIDEO_CASES = [((w, h), seconds, birds) for w, h in [(640, 360), (1280, 720)] for seconds in [2, 5] for birds in [1, 6]]
+VIDEO_FPS = 25
+
+QUICK_IMAGE_CASES = [((640, 480), 3), ((1280, 720), 3)]
+QUICK_VIDEO_CASES = [((640, 360), 2, 3)]
+
+
+## Synthetic media
+def background(width, height, rng):
+    # Sky-to-ground gradient with sensor noise
+    gradient = np.linspace(200, 90, height, dtype=np.float32)[:, None, None]
+    tint = np.array([1.0, 0.95, 0.8], dtype=np.float32)
+    image = gradient * tint + rng.normal(0, 6, (height, width, 3))
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def draw_birds(cv, image, positions, sizes, colors):
+    for (x, y), size, color in zip(positions, sizes, colors):
+        center = (int(x), int(y))
+        cv.ellipse(image, center, (int(size), int(size * 0.45)), 0, 0, 360, color, -1)
+        cv.circle(image, (int(x + size * 0.9), int(y - size * 0.2)), int(size * 0.3), color, -1)
+        cv.ellipse(image, (int(x - size * 0.2), int(y - size * 0.3)), (int(size * 0.7), int(size * 0.2)), -30, 0, 360, color, -1)
+    return image
+
+
+def bird_params(width, height, birds, rng):
+    sizes = rng.uniform(0.03, 0.08, birds) * min(width, height)
+    positions = np.stack([rng.uniform(0.1, 0.9, birds) * width, rng.uniform(0.1, 0.9, birds) * height], axis=1)
+    colors = [tuple(int(c) for c in rng.integers(10, 90, 3)) for _ in range(birds)]
+    return positions, sizes, colors
+
+
+def synthetic_image(cv, size, birds):
+    path = os.path.join(DATA_DIR, f"image_{size[0]}x{size[1]}_{birds}birds.jpg")
+    if not os.path.exists(path):
+        rng = np.random.default_rng(SEED)
+        image = background(*size, rng)
+        draw_birds(cv, image, *bird_params(*size, birds, rng))
+        cv.imwrite(path, image)
+    return path
+
+
+def synthetic_video(cv, size, seconds, birds):
+    path = os.path.join(DATA_DIR, f"video_{size[0]}x{size[1]}_{seconds}s_{birds}birds.mp4")
+    if os.path.exists(path):
+        return path
+
+    rng = np.random.default_rng(SEED)
+    width, height = size
+    still = background(width, height, rng)
+    positions, sizes, colors = bird_params(width, height, birds, rng)
+    velocity = rng.uniform(-0.01, 0.01, (birds, 2)) * np.array([width, height])
+
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*'mp4v'), VIDEO_FPS, size)
+    for _ in range(seconds * VIDEO_FPS):
+        positions = positions + velocity
+        # Bounce off the frame edges
+        outside = (positions < 0) | (positions > [width, height])
+        velocity[outside] *= -1
+        writer.write(draw_birds(cv, still.copy(), positions, sizes, colors))
+    writer.release()
+    return path
+
+
+def benchmark_model(path):
+    # Untrained yolov8n, built from its config so no weights are downloaded
+    if not os.path.exists(path):
+        import torch
+        import ultralytics
+        torch.manual_seed(SEED)
+        ultralytics.YOLO('yolov8n.yaml').save(path)
+    return path
+
+
+## Measurement
+class TimedModel:
+    """Wraps the loaded model and records the per-image latency of every forward pass."""
+
+    def __init__(self, model):
+        self.model = model
+        self.latencies = []
+
+    def __call__(self, images, **kwargs):
+        started = time.perf_counter()
+        kwargs.setdefault('verbose', False)
+        results = self.model(images, **kwargs)
+        count = len(images) if isinstance(images, list) else 1
+        self.latencies.extend([(time.perf_counter() - started) / count] * count)
+        return results
+
+    def __getattr__(self, attr):
+        return getattr(self.model, attr)
+
+
+def reset_peak_rss():
+    # Linux resets the VmHWM high-water mark when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    import resource
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def summarise(latencies, frames, elapsed):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'frames': frames,
+        'seconds': round(elapsed, 3),
+        'fps': round(frames / elapsed, 2) if elapsed else None,
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 2) if len(latencies_ms) else None,
+        'p95_ms': round(float(np.percentile(latencies_ms, 95)), 2) if len(latencies_ms) else None,
+        'inference_frames': len(latencies),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_image_case(bird_detection, timed, cv, size, birds, repeats):
+    path = synthetic_image(cv, size, birds)
+    timed.latencies = []
+    reset_peak_rss()
+
+    started = time.perf_counter()
+    for _ in range(repeats):
+        bird_detection.image_prediction(path)
+    elapsed = time.perf_counter() - started
+
+    return {'kind': 'image', 'resolution': f"{size[0]}x{size[1]}", 'birds': birds, 'repeats': repeats,
+            **summarise(timed.latencies, repeats, elapsed)}
+
+
+def run_video_case(bird_detection, timed, cv, size, seconds, birds):
+    path = synthetic_video(cv, size, seconds, birds)
+    timed.latencies = []
+    reset_peak_rss()
+
+    started = time.perf_counter()
+    bird_detection.video_prediction(path)
+    elapsed = time.perf_counter() - started
+
+    # fps counts every frame of the video, sampled or not
+    return {'kind': 'video', 'resolution': f"{size[0]}x{size[1]}", 'seconds_of_video': seconds, 'birds': birds,
+            **summarise(timed.latencies, seconds * VIDEO_FPS, elapsed)}
+
+
+## Results
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment(bird_detection):
+    import torch
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'torch': torch.__version__,
+        'backend': bird_detection.MODEL_BACKEND,
+        'settings': {var: os.environ[var] for var in sorted(os.environ)
+                     if var.startswith(('VIDEO_', 'IMAGE_', 'DETECTION_', 'CASCADE_', 'CPU_THREADS', 'MOTION_'))},
+    }
+
+
+def case_name(case):
+    extra = f"_{case['seconds_of_video']}s" if case['kind'] == 'video' else ''
+    return f"{case['kind']}_{case['resolution']}{extra}_{case['birds']}birds"
+
+
+def compare_with(baseline_path, results):
+    with open(baseline_path) as f:
+        baseline = {case_name(case): case for case in json.load(f)['cases']}
+
+    print(f"Against {baseline_path}:")
+    for case in results['cases']:
+        old = baseline.get(case_name(case))
+        if old and old['fps'] and case['fps']:
+            print(f"  {case_name(case):40s} {old['fps']:8.2f} -> {case['fps']:8.2f} fps ({case['fps'] / old['fps'] - 1:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline CPU benchmark of image and video prediction")
+    parser.add_argument('--quick', action='store_true', help="a small subset of the cases")
+    parser.add_argument('--model', default=None, help="a YOLO checkpoint instead of the generated one")
+    parser.add_argument('--image-repeats', type=int, default=10)
+    parser.add_argument('--output', default=None, help="default benchmark-<commit>.json")
+    parser.add_argument('--baseline', default=None, help="an earlier results file to compare against")
+    args = parser.parse_args()
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    model_dir = os.path.join(DATA_DIR, 'model')
+    os.makedirs(model_dir, exist_ok=True)
+    model_path = os.path.join(model_dir, 'model.pt')
+    if args.model:
+        if os.path.lexists(model_path):
+            os.remove(model_path)
+        os.symlink(os.path.abspath(args.model), model_path)
+    else:
+        benchmark_model(model_path)
+
+    # Serve the model the way a baked-in image would, before bird_detection reads the setting
+    os.environ['BUNDLED_MODEL_DIR'] = model_dir
+    os.environ.setdefault('WARM_START', 'false')
+    import bird_detection
+    import cv2 as cv
+
+    started = time.perf_counter()
+    model = bird_detection.load_model()
+    model_load_seconds = round(time.perf_counter() - started, 3)
+
+    timed = TimedModel(model)
+    bird_detection.yolo_model = timed
+    timed(np.zeros((640, 640, 3), dtype=np.uint8))  # first pass allocates, keep it out of the cases
+
+    image_cases = QUICK_IMAGE_CASES if args.quick else IMAGE_CASES
+    video_cases = QUICK_VIDEO_CASES if args.quick else VIDEO_CASES
+
+    cases = []
+    for size, birds in image_cases:
+        cases.append(run_image_case(bird_detection, timed, cv, size, birds, args.image_repeats))
+        print(json.dumps(cases[-1]))
+    for size, seconds, birds in video_cases:
+        cases.append(run_video_case(bird_detection, timed, cv, size, seconds, birds))
+        print(json.dumps(cases[-1]))
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'model': args.model or 'yolov8n (untrained, generated)',
+        'model_load_seconds': model_load_seconds,
+        'cold_start_timings': bird_detection.COLD_START_TIMINGS,
+        'environment': environment(bird_detection),
+        'cases': cases,
+    }
+
+    output = args.output or f"benchmark-{commit or 'local'}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        compare_with(args.baseline, results)
+
+
+if __name__ == '__main__':
+    main()
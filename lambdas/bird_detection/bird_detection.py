@@ -4,47 +4,312 @@
 # requirements
 # !pip install ultralytics supervision
 
-from ultralytics import YOLO
-import supervision as sv
-import cv2 as cv
+import time
+IMPORT_STARTED = time.perf_counter()
+
+import importlib
 import numpy as np
-import matplotlib.pyplot as plt
 import os
+import shutil
 import boto3
-import requests
+from botocore.exceptions import ClientError
 import json
+import queue
+import threading
+import multiprocessing
+from s3_download import TRANSFER_CONFIG, download
+from cpu_threads import available_cpus, configure_threads, thread_count
+
+
+## Deferred imports
+class LazyModule:
+    """
+    Stands in for a heavy module and imports it on first attribute access,
+    so importing this file stays cheap and the cost is paid where it is used.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def load(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+
+ultralytics = LazyModule('ultralytics')
+sv = LazyModule('supervision')
+cv = LazyModule('cv2')
+
+def import_detection_modules():
+    # Pay for the deferred imports in one place so they show up in the cold start timings
+    started = time.perf_counter()
+    for module in (ultralytics, sv, cv):
+        module.load()
+    # torch (loaded by ultralytics) and OpenCV default to more threads than a Lambda has vCPUs
+    configure_threads()
+    COLD_START_TIMINGS['import'] += round(time.perf_counter() - started, 3)
+
+# Cold start phase timings, in seconds
+COLD_START_TIMINGS = {'import': round(time.perf_counter() - IMPORT_STARTED, 3), 'download': 0.0, 'load': 0.0, 'warmup': 0.0}
 
 # Model path
 MODEL_BUCKET = 'birdtag-cloud170'
 MODEL_KEY = 'models/model.pt'
 MODEL_PATH = '/tmp/model.pt'
+MODEL_MANIFEST_PATH = '/tmp/model_manifest.json'  # S3 ETag of every model file in /tmp
+BUNDLED_MODEL_DIR = os.environ.get('BUNDLED_MODEL_DIR', '/opt/models')  # model files baked into the image at deploy time
 s3_client = boto3.client('s3')
 
+# Parallel ranged GETs for model downloads
+MODEL_TRANSFER_CONFIG = TRANSFER_CONFIG
+
+# Inference backend: 'torch' (model.pt), 'onnx' or 'onnx-int8' (ONNX Runtime, exported once and cached in S3)
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'torch')
+ONNX_MODEL_KEYS = {
+    'onnx': 'models/model.onnx',
+    'onnx-int8': 'models/model.int8.onnx',
+}
+
+# Two-stage resolution cascade: a cheap low-resolution screen, full resolution only for candidates
+DETECTION_CASCADE = os.environ.get('DETECTION_CASCADE', 'false').lower() == 'true'
+CASCADE_IMGSZ = int(os.environ.get('CASCADE_IMGSZ', '320'))
+CASCADE_THRESHOLD = float(os.environ.get('CASCADE_THRESHOLD', '0.1'))
+
+# In-memory media: images decode from the S3 bytes, videos stream from a presigned URL
+VIDEO_STREAMING = os.environ.get('VIDEO_STREAMING', 'true').lower() == 'true'
+VIDEO_URL_EXPIRES = 2 * 60 * 60  # long enough for checkpointed and segment-parallel runs
+
+# Batched image inference
+IMAGE_BATCH_SIZE = int(os.environ.get('IMAGE_BATCH_SIZE', '8'))
+
+# Batched video inference
+VIDEO_BATCH_SIZE = int(os.environ.get('VIDEO_BATCH_SIZE', '8'))
+VIDEO_BATCH_MAX_MB = int(os.environ.get('VIDEO_BATCH_MAX_MB', '256'))
+
+# Background frame decoding
+VIDEO_QUEUE_SIZE = int(os.environ.get('VIDEO_QUEUE_SIZE', '16'))
+VIDEO_DECODER_THREADS = int(os.environ.get('VIDEO_DECODER_THREADS', '1'))
+
+# Temporal frame sampling
+VIDEO_FRAME_STRIDE = int(os.environ.get('VIDEO_FRAME_STRIDE', '1'))
+VIDEO_TARGET_FPS = float(os.environ.get('VIDEO_TARGET_FPS', '0'))  # 0 analyses at the stride above
+VIDEO_ADAPTIVE_SAMPLING = os.environ.get('VIDEO_ADAPTIVE_SAMPLING', 'false').lower() == 'true'
+ADAPTIVE_STATIC_FRAMES = 3  # unchanged analysed frames before the stride is doubled
+ADAPTIVE_READ_AHEAD = int(os.environ.get('ADAPTIVE_READ_AHEAD', '4'))  # queued and batched frames per decoder in adaptive mode
+
+# Motion gating for static-camera footage
+VIDEO_MOTION_GATING = os.environ.get('VIDEO_MOTION_GATING', 'false').lower() == 'true'
+MOTION_MASK_WIDTH = 320  # background subtraction runs on a downscaled frame
+MOTION_MIN_AREA = 0.0005  # smallest moving blob, as a fraction of the frame
+MOTION_PADDING = 32  # pixels of context added around each moving region
+MOTION_MIN_REGION = 160  # smallest crop handed to the detector
+
+# Segment-parallel video detection
+VIDEO_SEGMENTS = int(os.environ.get('VIDEO_SEGMENTS', '1'))  # 1 processes the video serially
+VIDEO_SEGMENT_WORKERS = int(os.environ.get('VIDEO_SEGMENT_WORKERS', str(available_cpus())))
+SEGMENT_WARMUP_SECONDS = 1.0  # frames decoded before each segment only to warm up the tracker
+
+# Checkpointing long videos before the Lambda deadline
+CHECKPOINT_MARGIN_MS = int(os.environ.get('CHECKPOINT_MARGIN_MS', '30000'))
+
+# Early exit for fast tagging, 0 scans the whole video
+VIDEO_CONVERGE_SECONDS = float(os.environ.get('VIDEO_CONVERGE_SECONDS', '0'))  # stop after this long without a new max count
+VIDEO_COMPUTE_BUDGET_SECONDS = float(os.environ.get('VIDEO_COMPUTE_BUDGET_SECONDS', '0'))  # stop after this much processing time
+
 # Cached model
 yolo_model = None
 
-def load_model():
+def load_model(backend=MODEL_BACKEND):
     
     global yolo_model
     
     if yolo_model is None:
-        if not os.path.exists(MODEL_PATH):
-            
-            print("Downloading model from S3...")
-            s3_client.download_file(MODEL_BUCKET, MODEL_KEY, MODEL_PATH)
+        import_detection_modules()
+        model_path = fetch_torch_model() if backend == 'torch' else fetch_onnx_model(backend)
 
-        yolo_model = YOLO(MODEL_PATH)
+        started = time.perf_counter()
+        # ultralytics runs .onnx weights through ONNX Runtime with the same pre/post-processing
+        yolo_model = ultralytics.YOLO(model_path, task='detect')
+        COLD_START_TIMINGS['load'] = round(time.perf_counter() - started, 3)
 
     return yolo_model
 
+def warm_start(backend=MODEL_BACKEND):
+    # Meant to run during the Lambda init phase, so the first request doesn't pay for it
+    model = load_model(backend)
+
+    started = time.perf_counter()
+    blank = np.zeros((640, 640, 3), dtype=np.uint8)
+    model(blank, imgsz=full_imgsz(model), verbose=False)
+    if DETECTION_CASCADE:
+        model(blank, imgsz=CASCADE_IMGSZ, verbose=False)
+    COLD_START_TIMINGS['warmup'] = round(time.perf_counter() - started, 3)
+
+    print(f"Cold start timings: {json.dumps(COLD_START_TIMINGS)}")
+    return model
+
+def read_model_manifest():
+    if not os.path.exists(MODEL_MANIFEST_PATH):
+        return {}
+    with open(MODEL_MANIFEST_PATH) as f:
+        return json.load(f)
+
+def write_model_manifest(manifest):
+    with open(MODEL_MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f)
+
+def sync_model_file(key, path):
+    # A model baked into the image wins, otherwise re-download only if the S3 ETag changed
+    bundled_path = os.path.join(BUNDLED_MODEL_DIR, os.path.basename(key))
+    if os.path.exists(bundled_path):
+        return bundled_path
+
+    etag = s3_client.head_object(Bucket=MODEL_BUCKET, Key=key)['ETag']
+    manifest = read_model_manifest()
+    if os.path.exists(path) and manifest.get(key) == etag:
+        return path
+
+    print(f"Downloading {key} from S3...")
+    started = time.perf_counter()
+    s3_client.download_file(MODEL_BUCKET, key, path, Config=MODEL_TRANSFER_CONFIG)
+    COLD_START_TIMINGS['download'] += round(time.perf_counter() - started, 3)
+
+    manifest[key] = etag
+    write_model_manifest(manifest)
+    return path
+
+def fetch_torch_model():
+    return sync_model_file(MODEL_KEY, MODEL_PATH)
+
+def fetch_onnx_model(backend):
+    if backend not in ONNX_MODEL_KEYS:
+        raise ValueError(f"Unsupported model backend: {backend}")
+
+    onnx_key = ONNX_MODEL_KEYS[backend]
+    onnx_path = f"/tmp/{os.path.basename(onnx_key)}"
+
+    try:
+        return sync_model_file(onnx_key, onnx_path)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+
+    export_onnx_model(backend, onnx_path)
+    print(f"Caching {backend} model in S3 at {onnx_key}")
+    s3_client.upload_file(onnx_path, MODEL_BUCKET, onnx_key, Config=MODEL_TRANSFER_CONFIG)
+
+    manifest = read_model_manifest()
+    manifest[onnx_key] = s3_client.head_object(Bucket=MODEL_BUCKET, Key=onnx_key)['ETag']
+    write_model_manifest(manifest)
+    return onnx_path
+
+def export_onnx_model(backend, onnx_path):
+    print(f"No cached {backend} model, exporting {MODEL_PATH}...")
+    torch_path = fetch_torch_model()
+    if os.path.dirname(torch_path) != os.path.dirname(onnx_path):
+        # ultralytics exports next to the weights, and a bundled model lives on a read-only path
+        shutil.copy(torch_path, MODEL_PATH)
+        torch_path = MODEL_PATH
+
+    # Dynamic axes so batched and low-resolution (cascade) inputs still work. No graph simplification:
+    # it needs onnxslim, which the images don't ship, and ultralytics would try to pip install it at runtime
+    exported_path = ultralytics.YOLO(torch_path).export(format='onnx', dynamic=True, simplify=False)
+
+    if backend == 'onnx-int8':
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(exported_path, onnx_path, weight_type=QuantType.QUInt8)
+    elif exported_path != onnx_path:
+        os.replace(exported_path, onnx_path)
+
+def full_imgsz(model):
+    # The predictor keeps the imgsz of its previous call, so after a cascade screen an
+    # ONNX model (whose overrides carry no imgsz) would stay at CASCADE_IMGSZ unless told
+    return model.overrides.get('imgsz', 640)
+
+def run_model(model, images, cascade=False, imgsz=None):
+    # Returns one sv.Detections per image, in order; imgsz defaults to the model's full size
+    imgsz = imgsz or full_imgsz(model)
+    if not cascade:
+        return [sv.Detections.from_ultralytics(result) for result in model(images, imgsz=imgsz)]
+
+    # Screen at low resolution and only re-run candidates at full resolution
+    screen = model(images, imgsz=min(CASCADE_IMGSZ, imgsz), conf=CASCADE_THRESHOLD)
+    candidates = [i for i, result in enumerate(screen) if len(result.boxes)]
+
+    detections = [sv.Detections.empty() for _ in images]
+    if candidates:
+        for i, result in zip(candidates, model([images[i] for i in candidates], imgsz=imgsz)):
+            detections[i] = sv.Detections.from_ultralytics(result)
+    return detections
+
+## In-memory Media
+def decode_image(data):
+    # Decode encoded image bytes straight into a BGR array, without a temp file
+    image = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Error: couldn't decode the image!")
+    return image
+
+def video_source(bucket_name, object_key, fallback_path):
+    # OpenCV's FFmpeg backend reads a presigned URL with ranged HTTP requests, so the video
+    # is never staged on disk; the file is only downloaded if the URL can't be opened
+    if VIDEO_STREAMING:
+        url = s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket_name, 'Key': object_key},
+            ExpiresIn=VIDEO_URL_EXPIRES
+        )
+        cap = cv.VideoCapture(url)
+        opened = cap.isOpened()
+        cap.release()
+        if opened:
+            return url
+        print("Couldn't stream the video, downloading it instead")
+
+    return download(s3_client, bucket_name, object_key, fallback_path)
+
 ## Image Detection
-def image_prediction(image_path, confidence=0.3):
+def image_prediction(image_path, confidence=0.3, cascade=DETECTION_CASCADE, detections_path=None):
     model = load_model()
     class_dict = model.names
 
-    result = model(image_path)[0]
-    detections = sv.Detections.from_ultralytics(result)
+    detections = run_model(model, [image_path], cascade)[0]
+    species_counts = count_species(detections, class_dict, confidence)
 
+    if detections_path:
+        detection_log = DetectionLog(class_dict, 'image')
+        detection_log.add(0, detections)
+        detection_log.save(detections_path)
+
+    return json.dumps(species_counts)
+
+
+def image_prediction_batch(paths_or_arrays, confidence=0.3, batch_size=IMAGE_BATCH_SIZE, cascade=DETECTION_CASCADE,
+                           detections_paths=None):
+    # ultralytics letterboxes a list of images and stacks them into one forward pass
+    model = load_model()
+    class_dict = model.names
+
+    species_counts = []
+    for start in range(0, len(paths_or_arrays), batch_size):
+        batch = list(paths_or_arrays[start:start + batch_size])
+        for i, detections in enumerate(run_model(model, batch, cascade), start):
+            species_counts.append(count_species(detections, class_dict, confidence))
+
+            if detections_paths:
+                detection_log = DetectionLog(class_dict, 'image')
+                detection_log.add(0, detections)
+                detection_log.save(detections_paths[i])
+
+    return species_counts
+
+
+def count_species(detections, class_dict, confidence):
     species_counts = {}
 
     if detections.class_id is not None:
@@ -54,58 +319,768 @@ def image_prediction(image_path, confidence=0.3):
             species = class_dict[cls_id].lower()
             species_counts[species] = species_counts.get(species, 0) + 1
 
-    return json.dumps(species_counts)
+    return species_counts
 
 
-## Video Detection
-def video_prediction(video_path, confidence=0.3):
+## Raw Detections
+COUNTING_RULES = ('max_per_frame', 'unique_tracks', 'presence')
 
-    try:
-        # Load video info and extract width, height, and frames per second (fps)
-        video_info = sv.VideoInfo.from_video_path(video_path=video_path)
-        w, h, fps = int(video_info.width), int(video_info.height), int(video_info.fps)
+class DetectionLog:
+    """
+    Keeps every detection (frame index, class id, confidence, tracker id, box)
+    from before the confidence filter and saves them as a compressed .npz, so
+    tags can be recomputed for a new threshold or counting rule without
+    running the model again. Images are stored as frame 0 with tracker id -1.
+    """
 
-        model = load_model()
-        tracker = sv.ByteTrack(frame_rate=fps)  # Initialize the tracker with the video's frame rate
-        class_dict = model.names  # Get the class labels from the model
-        max_species_counts = {}
-        
-        # Capture the video from the given path
-        cap = cv.VideoCapture(video_path)
-        if not cap.isOpened():
-            raise Exception("Error: couldn't open the video!")
-
-        # Process the video frame by frame
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:  # End of the video
+    def __init__(self, class_dict, media_type):
+        self.class_names = [class_dict[i] for i in sorted(class_dict)]
+        self.media_type = media_type
+        self.frame_index, self.class_id, self.confidence, self.tracker_id, self.xyxy = [], [], [], [], []
+
+    def add(self, frame_index, detections):
+        n = len(detections)
+        if n == 0:
+            return
+
+        tracker_id = detections.tracker_id if detections.tracker_id is not None else np.full(n, -1)
+        self.frame_index.append(np.full(n, frame_index, dtype=np.int32))
+        self.class_id.append(detections.class_id.astype(np.int16))
+        self.confidence.append(detections.confidence.astype(np.float32))
+        self.tracker_id.append(tracker_id.astype(np.int32))
+        self.xyxy.append(detections.xyxy.astype(np.float32))
+
+    def save(self, path):
+        def stack(parts, dtype, shape=(0,)):
+            return np.concatenate(parts) if parts else np.zeros(shape, dtype=dtype)
+
+        np.savez_compressed(
+            path,
+            frame_index=stack(self.frame_index, np.int32),
+            class_id=stack(self.class_id, np.int16),
+            confidence=stack(self.confidence, np.float32),
+            tracker_id=stack(self.tracker_id, np.int32),
+            xyxy=stack(self.xyxy, np.float32, (0, 4)),
+            class_names=np.array(self.class_names),
+            media_type=np.array(self.media_type),
+        )
+
+
+def recompute_tags(detections_file, confidence=0.3, rule='max_per_frame'):
+    """
+    Recomputes the {species: count} tags from a saved DetectionLog (a path or
+    file object). 'max_per_frame' matches image_prediction/video_prediction,
+    'unique_tracks' counts distinct tracked birds and 'presence' gives 1 per species.
+    """
+    if rule not in COUNTING_RULES:
+        raise ValueError(f"Unsupported counting rule: {rule}")
+
+    with np.load(detections_file) as data:
+        keep = data['confidence'] > confidence
+        frame_index = data['frame_index'][keep]
+        class_id = data['class_id'][keep]
+        tracker_id = data['tracker_id'][keep]
+        class_names = data['class_names']
+
+    species_counts = {}
+    for cls_id in np.unique(class_id):
+        mask = class_id == cls_id
+        if rule == 'max_per_frame':
+            count = int(np.bincount(frame_index[mask]).max())
+        elif rule == 'unique_tracks':
+            ids = tracker_id[mask]
+            count = len(np.unique(ids[ids >= 0])) + int((ids < 0).sum())  # untracked (image) detections count once each
+        else:
+            count = 1
+        species_counts[str(class_names[cls_id]).lower()] = count
+
+    return species_counts
+
+
+## Frame Sampling
+class FrameSampler:
+    """
+    Decides which frames are analysed. A fixed stride analyses every n-th
+    frame; in adaptive mode the stride halves (down to 1) as soon as the
+    per-frame species counts change and doubles (up to one frame per second)
+    after a few unchanged analysed frames.
+    """
+
+    def __init__(self, fps, stride=VIDEO_FRAME_STRIDE, target_fps=VIDEO_TARGET_FPS, adaptive=VIDEO_ADAPTIVE_SAMPLING):
+        if target_fps:
+            stride = round(fps / target_fps)
+        self.base_stride = max(1, int(stride))
+        self.stride = self.base_stride
+        self.adaptive = adaptive
+        self.max_stride = max(self.base_stride, int(fps))
+        self.last_counts = None
+        self.static_frames = 0
+        self.analysed = 0
+
+    def tracker_frame_rate(self, fps):
+        # ByteTrack must see the rate frames are actually analysed at. The adaptive stride moves
+        # up to max_stride, so size the lost-track buffer for the coarsest stride: at finer strides
+        # a lost track is dropped sooner, never kept longer than intended.
+        return max(1, round(fps / (self.max_stride if self.adaptive else self.base_stride)))
+
+    def keep(self, index):
+        # Stateless check so it is safe to call from several decoder threads
+        return index % self.stride == 0
+
+    def update(self, frame_species_counts):
+        self.analysed += 1
+        if not self.adaptive:
+            return
+
+        if self.last_counts is not None and frame_species_counts != self.last_counts:
+            self.stride = max(1, self.stride // 2)
+            self.static_frames = 0
+        else:
+            self.static_frames += 1
+            if self.static_frames >= ADAPTIVE_STATIC_FRAMES:
+                self.stride = min(self.max_stride, self.stride * 2)
+                self.static_frames = 0
+        self.last_counts = frame_species_counts
+
+    def stats(self):
+        return {
+            'analysed_frames': self.analysed,
+            'base_stride': self.base_stride,
+            'final_stride': self.stride,
+            'adaptive': self.adaptive,
+        }
+
+
+## Motion Gating
+class MotionGate:
+    """
+    Background subtraction (MOG2) over the analysed frames. Returns the merged
+    bounding regions of anything that moved, in full-frame coordinates, or an
+    empty list for a static frame.
+    """
+
+    def __init__(self):
+        self.subtractor = cv.createBackgroundSubtractorMOG2(detectShadows=False)
+        self.kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (3, 3))
+        self.frames = 0
+        self.motion_frames = 0
+        self.region_area = 0.0
+        self.full_frames = 0  # motion frames whose crops would cost more than the frame
+
+    def regions(self, frame):
+        h, w = frame.shape[:2]
+        scale = min(1.0, MOTION_MASK_WIDTH / w)
+        small = cv.resize(frame, (int(w * scale), int(h * scale))) if scale < 1.0 else frame
+
+        mask = self.subtractor.apply(small)
+        mask = cv.morphologyEx(mask, cv.MORPH_OPEN, self.kernel)
+        mask = cv.dilate(mask, self.kernel, iterations=2)
+        contours, _ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+
+        min_area = MOTION_MIN_AREA * mask.shape[0] * mask.shape[1]
+        boxes = []
+        for contour in contours:
+            if cv.contourArea(contour) < min_area:
+                continue
+            x, y, bw, bh = cv.boundingRect(contour)
+            boxes.append(self.to_frame(x / scale, y / scale, (x + bw) / scale, (y + bh) / scale, w, h))
+
+        boxes = merge_boxes(boxes)
+
+        self.frames += 1
+        if boxes:
+            self.motion_frames += 1
+            self.region_area += sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in boxes) / (w * h)
+        return boxes
+
+    def to_frame(self, x1, y1, x2, y2, w, h):
+        # Pad the region and grow it to the minimum crop size around its centre
+        x1, y1, x2, y2 = x1 - MOTION_PADDING, y1 - MOTION_PADDING, x2 + MOTION_PADDING, y2 + MOTION_PADDING
+        if x2 - x1 < MOTION_MIN_REGION:
+            cx = (x1 + x2) / 2
+            x1, x2 = cx - MOTION_MIN_REGION / 2, cx + MOTION_MIN_REGION / 2
+        if y2 - y1 < MOTION_MIN_REGION:
+            cy = (y1 + y2) / 2
+            y1, y2 = cy - MOTION_MIN_REGION / 2, cy + MOTION_MIN_REGION / 2
+        return max(0, int(x1)), max(0, int(y1)), min(w, int(x2)), min(h, int(y2))
+
+    def stats(self):
+        return {
+            'gated_frames': self.frames,
+            'motion_frames': self.motion_frames,
+            'skipped_frames': self.frames - self.motion_frames,
+            'mean_region_area': round(self.region_area / max(self.motion_frames, 1), 3),
+            'full_frame_fallbacks': self.full_frames,
+        }
+
+
+def merge_boxes(boxes):
+    # Union overlapping boxes until none overlap, so no area is detected twice
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for box in boxes:
+            for i, other in enumerate(result):
+                if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                    result[i] = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+                    merged = True
+                    break
+            else:
+                result.append(box)
+        boxes = result
+    return boxes
+
+
+## Frame Reader
+END_OF_SEGMENT = object()
+FRAME_COUNT_TOLERANCE = 0.01  # container frame counts can be slightly off, a larger shortfall is a failed read
+
+class TruncatedVideo(Exception):
+    """Raised when decoding stops well before the frames the container reports (a broken file or stream)."""
+
+class FrameReader:
+    """
+    Decodes video frames on background threads into bounded queues so that
+    decoding overlaps with inference. With several decoder threads, a seekable
+    video is split into contiguous frame ranges, one queue per range, and the
+    queues are drained in order so frames are still yielded in sequence.
+    The queues together hold at most max_queue_mb of decoded frames.
+    Frames the sampler skips are only grabbed, never retrieved, and the
+    reader yields (frame_index, frame) pairs from start_frame up to end_frame.
+    """
+
+    def __init__(self, video_path, queue_size=VIDEO_QUEUE_SIZE, decoder_threads=VIDEO_DECODER_THREADS, sampler=None,
+                 start_frame=0, end_frame=None, max_queue_mb=VIDEO_BATCH_MAX_MB):
+        self.video_path = video_path
+        self.sampler = sampler
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.expected_end = None  # frame the last range should reach, from the container's frame count
+        self.frame_bytes = 0  # size of one decoded frame, from the container's frame size
+
+        # Counters to tell which stage is the bottleneck
+        self.frames = 0
+        self.producer_stall = 0.0  # decoders waiting on a full queue -> inference bound
+        self.consumer_stall = 0.0  # inference waiting on an empty queue -> decode bound
+        self.depth_total = 0
+        self.depth_max = 0
+
+        ranges = self.split_ranges(decoder_threads)
+        self.queue_size = queue_limit(self.frame_bytes, queue_size, max_queue_mb, len(ranges))
+        self.queues = [queue.Queue(maxsize=self.queue_size) for _ in ranges]
+        self.threads = [
+            threading.Thread(target=self.decode, args=(q, start, end), daemon=True)
+            for q, (start, end) in zip(self.queues, ranges)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def split_ranges(self, decoder_threads):
+        cap = cv.VideoCapture(self.video_path)
+        try:
+            if not cap.isOpened():
+                raise Exception("Error: couldn't open the video!")
+
+            self.frame_bytes = int(cap.get(cv.CAP_PROP_FRAME_WIDTH)) * int(cap.get(cv.CAP_PROP_FRAME_HEIGHT)) * 3
+            total = int(cap.get(cv.CAP_PROP_FRAME_COUNT))
+            if self.end_frame is not None:
+                total = min(total, self.end_frame)
+            self.expected_end = total if total > 0 else None
+            if decoder_threads <= 1 or total <= self.start_frame or not cap.set(cv.CAP_PROP_POS_FRAMES, 0):
+                return [(self.start_frame, self.end_frame)]
+        finally:
+            cap.release()
+
+        step = -(-(total - self.start_frame) // decoder_threads)
+        starts = list(range(self.start_frame, total, step))
+        # The last range reads to end_frame in case the container's frame count is off
+        return [(start, start + step if i < len(starts) - 1 else self.end_frame) for i, start in enumerate(starts)]
+
+    def decode(self, frame_queue, start, end):
+        cap = cv.VideoCapture(self.video_path)
+        try:
+            if start:
+                cap.set(cv.CAP_PROP_POS_FRAMES, start)
+
+            position = start
+            ran_out = False
+            while not self.stop_event.is_set() and (end is None or position < end):
+                if self.sampler is not None and not self.sampler.keep(position):
+                    if not cap.grab():  # End of the video
+                        ran_out = True
+                        break
+                    position += 1
+                    continue
+
+                ret, frame = cap.read()
+                if not ret:  # End of the video
+                    ran_out = True
+                    break
+                self.put(frame_queue, (position, frame))
+                position += 1
+
+            if ran_out:
+                self.check_complete(frame_queue, position, end)
+        finally:
+            cap.release()
+            self.put(frame_queue, END_OF_SEGMENT)
+
+    def check_complete(self, frame_queue, position, end):
+        # A range the reader split off must be read to its end; the last one must get close to the frame count
+        if end is not None and end != self.end_frame:
+            expected, tolerance = end, 0
+        else:
+            expected = self.expected_end
+            tolerance = int(expected * FRAME_COUNT_TOLERANCE) if expected else 0
+        if expected and position < expected - tolerance:
+            self.put(frame_queue, TruncatedVideo(f"Decoding stopped at frame {position} of {expected}"))
+
+    def put(self, frame_queue, item):
+        began = time.perf_counter()
+        while not self.stop_event.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
                 break
+            except queue.Full:
+                continue
+
+        with self.lock:
+            self.producer_stall += time.perf_counter() - began
+
+    def __iter__(self):
+        for frame_queue in self.queues:
+            while True:
+                depth = frame_queue.qsize()
+                self.depth_total += depth
+                self.depth_max = max(self.depth_max, depth)
+
+                began = time.perf_counter()
+                item = frame_queue.get()
+                self.consumer_stall += time.perf_counter() - began
+
+                if item is END_OF_SEGMENT:
+                    break
+                if isinstance(item, TruncatedVideo):
+                    raise item
+
+                self.frames += 1
+                yield item
+
+    def close(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'decoder_threads': len(self.threads),
+            'queue_size': self.queue_size,
+            'queue_depth_max': self.depth_max,
+            'queue_depth_mean': round(self.depth_total / max(self.frames, 1), 2),
+            'decode_stall_seconds': round(self.consumer_stall, 3),
+            'inference_stall_seconds': round(self.producer_stall, 3),
+        }
+
+
+## Video Detection
+def queue_limit(frame_bytes, queue_size, max_queue_mb, queues):
+    # Cap the frames each decoder queue holds so all the queues together stay under the memory ceiling
+    if not frame_bytes:
+        return queue_size
+    frames_in_ceiling = (max_queue_mb * 1024 * 1024) // (frame_bytes * queues)
+    return max(1, min(queue_size, frames_in_ceiling))
+
 
-            # Make predictions on the current frame using the YOLO model
-            result = model(frame)[0]
-            detections = sv.Detections.from_ultralytics(result)  # Convert model output to Detections format
-            detections = tracker.update_with_detections(detections=detections)  # Track detected objects
+def batch_limit(frame, batch_size, max_batch_mb):
+    # Cap the number of buffered frames so a batch stays under the memory ceiling
+    frames_in_ceiling = (max_batch_mb * 1024 * 1024) // frame.nbytes
+    return max(1, min(batch_size, frames_in_ceiling))
+
+
+def crop_imgsz(crop, full):
+    # Inference size for a motion crop: its longer side on the model's 32 px grid, rounded
+    # down so the crop is never upscaled, and never above the full-frame size
+    return max(32, min(full, max(crop.shape[:2]) // 32 * 32))
+
+
+def input_pixels(shape, imgsz):
+    # Pixels the model sees for an image letterboxed to imgsz (minimal padding to the 32 px grid)
+    h, w = shape[:2]
+    return imgsz * (-(-round(min(h, w) * imgsz / max(h, w)) // 32) * 32)
+
+
+def detect_batch(model, frames, motion_gate=None, cascade=False):
+    # One forward pass for the whole batch, results come back in frame order
+    if motion_gate is None:
+        return run_model(model, frames, cascade)
+
+    # Only the moving regions are sent to the model, each crop at its own size; static frames
+    # get no detections, and a frame whose crops would cost more than itself is run whole
+    full = full_imgsz(model)
+    whole, crops = [], {}
+    for i, frame in enumerate(frames):
+        regions = [(frame[y1:y2, x1:x2], (x1, y1)) for x1, y1, x2, y2 in motion_gate.regions(frame)]
+        sizes = [crop_imgsz(crop, full) for crop, _ in regions]
+        if sum(input_pixels(crop.shape, size) for (crop, _), size in zip(regions, sizes)) >= input_pixels(frame.shape, full):
+            motion_gate.full_frames += 1
+            whole.append(i)
+            continue
+        for (crop, offset), size in zip(regions, sizes):
+            crops.setdefault(size, []).append((crop, i, offset))
+
+    frame_detections = [[] for _ in frames]
+    if whole:
+        for i, detections in zip(whole, run_model(model, [frames[i] for i in whole], cascade)):
+            frame_detections[i].append(detections)
+    for size, group in crops.items():
+        for detections, (_, i, (x, y)) in zip(run_model(model, [crop for crop, _, _ in group], cascade, size), group):
+            detections.xyxy = detections.xyxy + np.array([x, y, x, y], dtype=detections.xyxy.dtype)  # Map back to frame coordinates
+            frame_detections[i].append(detections)
+
+    return [sv.Detections.merge(d) if d else sv.Detections.empty() for d in frame_detections]
+
+
+class SpeciesCounter:
+    """
+    Runs the detector on batches of analysed frames, tracks the detections and
+    keeps the running maximum number of birds seen at once per species. Frames
+    before count_from only warm up the tracker and are not counted.
+    """
+
+    def __init__(self, model, tracker, confidence, motion_gate=None, cascade=False, detection_log=None,
+                 max_species_counts=None, count_from=0):
+        self.model = model
+        self.tracker = tracker
+        self.class_dict = model.names
+        self.confidence = confidence
+        self.motion_gate = motion_gate
+        self.cascade = cascade
+        self.detection_log = detection_log
+        self.max_species_counts = max_species_counts if max_species_counts is not None else {}
+        self.count_from = count_from
+        self.last_change_frame = count_from  # last frame that raised a max count
+
+    def process(self, frame_indices, frames):
+        batch_species_counts = []
+
+        for frame_index, detections in zip(frame_indices, detect_batch(self.model, frames, self.motion_gate, self.cascade)):
+            detections = self.tracker.update_with_detections(detections=detections)  # Track detected objects
+            if frame_index < self.count_from:
+                continue
+            if self.detection_log is not None:
+                self.detection_log.add(frame_index, detections)
 
             # Filter detections based on confidence
+            frame_species_counts = {}
             if detections.tracker_id is not None:
-                detections = detections[(detections.confidence > confidence)]  # Keep detections with confidence greater than a threashold
-
-                frame_species_counts = {}
-                for cls_id in detections.class_id:
-                    species = class_dict[cls_id].lower()
-                    frame_species_counts[species] = frame_species_counts.get(species, 0) + 1
+                frame_species_counts = count_species(detections, self.class_dict, self.confidence)
 
                 for species, count in frame_species_counts.items():
-                    cur_max = max_species_counts.get(species, 0)
+                    cur_max = self.max_species_counts.get(species, 0)
                     if count > cur_max:
-                        max_species_counts[species] = count
-        
-    except Exception as e:
-        print(f"An error occurred: {e}")
+                        self.max_species_counts[species] = count
+                        self.last_change_frame = frame_index
+
+            batch_species_counts.append(frame_species_counts)
+
+        return batch_species_counts
+
+
+def scan_video(video_path, fps, max_species_counts, confidence=0.3, start_frame=0, end_frame=None, count_from=0,
+               batch_size=VIDEO_BATCH_SIZE, max_batch_mb=VIDEO_BATCH_MAX_MB,
+               queue_size=VIDEO_QUEUE_SIZE, decoder_threads=VIDEO_DECODER_THREADS,
+               frame_stride=VIDEO_FRAME_STRIDE, target_fps=VIDEO_TARGET_FPS, adaptive_sampling=VIDEO_ADAPTIVE_SAMPLING,
+               motion_gating=VIDEO_MOTION_GATING, cascade=DETECTION_CASCADE, detection_log=None,
+               resume_state=None, time_left=None,
+               converge_seconds=VIDEO_CONVERGE_SECONDS, compute_budget_seconds=VIDEO_COMPUTE_BUDGET_SECONDS, report=None):
+    # Fills max_species_counts in place, so the counts so far survive an exception.
+    # time_left returns the remaining milliseconds; when it runs low, DeadlineReached
+    # carries the state needed to resume from the next frame.
+    # report (a dict) receives the frame the scan stopped at and why.
+
+    started = time.perf_counter()
+    if report is None:
+        report = {}
+    report.update({'stop_reason': 'end_of_video', 'stop_frame': None})
+
+    reader = None
+    sampler = None
+    motion_gate = None
+
+    try:
+        model = load_model()
+        if resume_state is not None:
+            sampler = resume_state['sampler']
+            tracker = resume_state['tracker']
+            start_frame = resume_state['next_frame']
+            max_species_counts.update(resume_state['max_species_counts'])
+            print(f"Resuming video at frame {start_frame}")
+        else:
+            sampler = FrameSampler(fps, stride=frame_stride, target_fps=target_fps, adaptive=adaptive_sampling)
+            tracker = sv.ByteTrack(frame_rate=sampler.tracker_frame_rate(fps))  # Initialize the tracker with the analysed frame rate
+        if sampler.adaptive:
+            # A new stride only applies to frames not yet decoded, so a long read-ahead
+            # would keep analysing at the old stride well after the counts changed
+            queue_size = min(queue_size, ADAPTIVE_READ_AHEAD)
+            batch_size = min(batch_size, ADAPTIVE_READ_AHEAD)
+        if motion_gating:
+            motion_gate = MotionGate()
+
+        counter = SpeciesCounter(model, tracker, confidence, motion_gate, cascade, detection_log, max_species_counts, count_from)
+        if resume_state is not None:
+            counter.last_change_frame = resume_state['last_change_frame']
+
+        # Decode the video on background threads while the model runs
+        reader = FrameReader(video_path, queue_size=queue_size, decoder_threads=decoder_threads, sampler=sampler,
+                             start_frame=start_frame, end_frame=end_frame, max_queue_mb=max_batch_mb)
+
+        # Process the sampled frames in batches
+        batch, batch_indices = [], []
+        limit = None
+        for index, frame in reader:
+            if limit is None:
+                limit = batch_limit(frame, batch_size, max_batch_mb)
+
+            batch.append(frame)
+            batch_indices.append(index)
+            if len(batch) >= limit:
+                for frame_species_counts in counter.process(batch_indices, batch):
+                    sampler.update(frame_species_counts)
+                batch, batch_indices = [], []
+
+                report['stop_frame'] = index + 1
+
+                # Early exit once the counts have settled or the compute budget is spent
+                if converge_seconds and index - counter.last_change_frame >= converge_seconds * fps:
+                    report['stop_reason'] = 'converged'
+                    break
+                if compute_budget_seconds and time.perf_counter() - started >= compute_budget_seconds:
+                    report['stop_reason'] = 'compute_budget'
+                    break
+
+                if time_left is not None and time_left() < CHECKPOINT_MARGIN_MS:
+                    raise DeadlineReached({
+                        'next_frame': index + 1,
+                        'max_species_counts': dict(max_species_counts),
+                        'last_change_frame': counter.last_change_frame,
+                        'tracker': tracker,
+                        'sampler': sampler,
+                        'detection_log': detection_log,
+                    })
+
+        # Flush the last partial batch
+        if batch:
+            for frame_species_counts in counter.process(batch_indices, batch):
+                sampler.update(frame_species_counts)
+            report['stop_frame'] = batch_indices[-1] + 1
 
     finally:
         # Release resources
-        cap.release()
-        print("Video processing complete, Released resources.")
-        return json.dumps(max_species_counts)
+        if reader is not None:
+            reader.close()
+            print(f"Frame reader stats: {json.dumps(reader.stats())}")
+        if sampler is not None:
+            print(f"Frame sampler stats: {json.dumps(sampler.stats())}")
+        if motion_gate is not None:
+            print(f"Motion gate stats: {json.dumps(motion_gate.stats())}")
+        print(f"Scan report: {json.dumps(report)}")
+
+    return max_species_counts
+
+
+class DeadlineReached(Exception):
+    """
+    Raised when a video scan stops early to checkpoint before the Lambda
+    deadline. state holds the next frame, the running max counts, the tracker,
+    the sampler and the detection log; pass it back as resume_state to continue.
+    The motion gate's background model is not kept and re-learns on resume.
+    In segment mode state holds the unfinished segments and the reports of the
+    finished ones instead.
+    """
+
+    def __init__(self, state):
+        super().__init__(f"Deadline reached, checkpointed at frame {state['next_frame']}")
+        self.state = state
+
+
+def video_prediction(video_path, confidence=0.3, detections_path=None, segments=VIDEO_SEGMENTS, segment_runner=None,
+                     resume_state=None, time_left=None, report=None, **options):
+    # options are passed on to scan_video (batching, decoding, sampling, motion gating, cascade, early exit).
+    # report (a dict) receives the frame the scan stopped at and why; in segment mode,
+    # the first segment that stopped early.
+    # Raises DeadlineReached instead of returning partial counts as if they were complete, and lets
+    # decode, stream and segment worker errors propagate for the same reason.
+
+    max_species_counts = {}
+
+    # Load video info and extract width, height, and frames per second (fps)
+    video_info = sv.VideoInfo.from_video_path(video_path=video_path)
+    w, h, fps = int(video_info.width), int(video_info.height), int(video_info.fps)
+
+    if resume_state is None:
+        segment_plan = plan_segments(video_info, segments)
+    else:
+        # A segment-mode checkpoint lists the segments still to scan
+        segment_plan = resume_state.get('segments', [])
+    if segment_plan:
+        if detections_path:
+            print("Raw detections are not recorded in segment mode")
+
+        runner = segment_runner or run_segments_in_processes
+        options = dict(options, confidence=confidence)
+        # The compute budget is for the whole video, each segment gets its share
+        compute_budget_seconds = options.get('compute_budget_seconds', VIDEO_COMPUTE_BUDGET_SECONDS)
+        if compute_budget_seconds:
+            options['compute_budget_seconds'] = compute_budget_seconds / len(segment_plan)
+        if time_left is not None:
+            options['deadline'] = time.time() + time_left() / 1000
+
+        results = runner(video_path, segment_plan, options)
+        prior_counts = [resume_state['max_species_counts']] if resume_state is not None else []
+        max_species_counts = merge_species_counts(prior_counts + [result['species_counts'] for result in results])
+
+        reports = [result['report'] for result in results]
+        remaining = resume_segments(segment_plan, reports, int(video_info.fps * SEGMENT_WARMUP_SECONDS))
+        finished = (resume_state or {}).get('reports', []) + [r for r in reports if r.get('stop_reason') != 'deadline']
+        if remaining:
+            raise DeadlineReached({
+                'next_frame': min(segment['count_from'] for segment in remaining),
+                'max_species_counts': max_species_counts,
+                'segments': remaining,
+                'reports': finished,
+            })
+        if report is not None:
+            report.update(merge_scan_reports(finished))
+
+    else:
+        if resume_state is not None:
+            detection_log = resume_state['detection_log']
+        else:
+            detection_log = DetectionLog(load_model().names, 'video') if detections_path else None
+        scan_video(video_path, fps, max_species_counts, confidence, detection_log=detection_log,
+                   resume_state=resume_state, time_left=time_left, report=report, **options)
+
+        if detection_log is not None:
+            detection_log.save(detections_path)
+
+    print("Video processing complete")
+    return json.dumps(max_species_counts)
+
+
+## Segment-parallel Video Detection
+def plan_segments(video_info, segments):
+    # Equal frame ranges; OpenCV seeks to the keyframe before each start and decodes forward,
+    # and every segment also decodes a short warm-up run so the tracker is settled at its start
+    total = int(video_info.total_frames or 0)
+    if segments <= 1 or total <= segments:
+        return []
+
+    step = -(-total // segments)
+    warmup = int(video_info.fps * SEGMENT_WARMUP_SECONDS)
+    plan = []
+    for start in range(0, total, step):
+        last = start + step >= total
+        plan.append({
+            'start_frame': max(0, start - warmup),
+            'count_from': start,
+            'end_frame': None if last else start + step,  # the last segment reads to the real end
+        })
+    return plan
+
+
+def segment_prediction(video_path, start_frame, count_from, end_frame=None, confidence=0.3, deadline=None, **options):
+    # Max species counts and scan report of one segment; runs in a worker process or a worker invocation.
+    # deadline (epoch seconds) is when the parent invocation ends: the segment stops in time for the
+    # parent to checkpoint, and its report says the frame to continue from.
+    video_info = sv.VideoInfo.from_video_path(video_path=video_path)
+    max_species_counts = {}
+    report = {}
+    time_left = (lambda: (deadline - time.time()) * 1000) if deadline is not None else None
+    try:
+        scan_video(video_path, int(video_info.fps), max_species_counts, confidence,
+                   start_frame=start_frame, end_frame=end_frame, count_from=count_from,
+                   time_left=time_left, report=report, **options)
+    except DeadlineReached as e:
+        report.update({'stop_reason': 'deadline', 'stop_frame': e.state['next_frame']})
+    return {'species_counts': max_species_counts, 'report': report}
+
+
+def merge_species_counts(results):
+    # A max of per-segment maxima equals the max over the whole video
+    merged = {}
+    for species_counts in results:
+        for species, count in species_counts.items():
+            merged[species] = max(merged.get(species, 0), count)
+    return merged
+
+
+def merge_scan_reports(reports):
+    # The video was scanned to the end only if every segment was; otherwise the
+    # first segment that stopped early gives the reason and the frame
+    for report in reports:
+        if report.get('stop_reason', 'end_of_video') != 'end_of_video':
+            return dict(report)
+    return {'stop_reason': 'end_of_video', 'stop_frame': reports[-1].get('stop_frame') if reports else None}
+
+
+def resume_segments(segments, reports, warmup):
+    # The segments a deadline cut short, continuing from where each stopped after a fresh tracker warm-up
+    remaining = []
+    for segment, report in zip(segments, reports):
+        if report.get('stop_reason') == 'deadline':
+            count_from = max(segment['count_from'], report['stop_frame'])
+            remaining.append({
+                'start_frame': max(segment['start_frame'], count_from - warmup),
+                'count_from': count_from,
+                'end_frame': segment['end_frame'],
+            })
+    return remaining
+
+
+def run_segments_inline(video_path, segments, options):
+    # Local stand-in for the parallel runners, handy for tests
+    return [segment_prediction(video_path, **segment, **options) for segment in segments]
+
+
+def segment_worker(conn, video_path, segment, options, threads):
+    configure_threads(threads)
+    try:
+        conn.send(('ok', segment_prediction(video_path, **segment, **options)))
+    except Exception as e:
+        conn.send(('error', str(e)))
+    finally:
+        conn.close()
+
+
+def run_segments_in_processes(video_path, segments, options, workers=VIDEO_SEGMENT_WORKERS):
+    # Lambda has no /dev/shm, so use plain processes and pipes rather than a Pool.
+    # Spawned (not forked) workers, because forking after torch has started its thread pool can hang.
+    ctx = multiprocessing.get_context('spawn')
+    threads = thread_count(min(workers, len(segments)))  # split the CPUs between concurrent workers
+    results = []
+
+    for wave in range(0, len(segments), workers):
+        running = []
+        for segment in segments[wave:wave + workers]:
+            parent_conn, child_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=segment_worker, args=(child_conn, video_path, segment, options, threads))
+            process.start()
+            child_conn.close()
+            running.append((process, parent_conn))
+
+        for process, parent_conn in running:
+            try:
+                status, result = parent_conn.recv()
+            except EOFError:
+                process.join()
+                status, result = 'error', f"worker exited with code {process.exitcode}"
+            process.join()
+            if status != 'ok':
+                raise Exception(f"Segment worker failed: {result}")
+            results.append(result)
 
+    return results
@@ -1,15 +1,248 @@
 import json
 import boto3
+from botocore.config import Config
 import os
-from bird_detection import image_prediction, video_prediction
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from bird_detection import image_prediction_batch, video_prediction, segment_prediction, warm_start, DeadlineReached
+from bird_detection import decode_image, video_source
+from workspace import workspace
+from content_cache import sha256_bytes, sha256_object, lookup, store, move_to_shared, DEDUP_SHARED_OBJECTS
 
 s3_client = boto3.client('s3')
 dynamodb = boto3.client('dynamodb')
+# Worker invokes are synchronous and can run up to the 15 minute Lambda limit; a retried
+# invoke would run the segment twice, so no retries and a read timeout past that limit
+lambda_client = boto3.client('lambda', config=Config(read_timeout=900, connect_timeout=10, retries={'max_attempts': 0}))
 table_name = 'birdtag_location'
 
+# Segment-parallel videos (VIDEO_SEGMENTS > 1) run in local worker processes ('process')
+# or as one invocation of SEGMENT_WORKER_FUNCTION per segment ('lambda')
+VIDEO_SEGMENT_RUNNER = os.environ.get('VIDEO_SEGMENT_RUNNER', 'process')
+SEGMENT_WORKER_FUNCTION = os.environ.get('SEGMENT_WORKER_FUNCTION', os.environ.get('AWS_LAMBDA_FUNCTION_NAME', ''))
+
+# Videos that run into the Lambda deadline are checkpointed here and continued by a new invocation
+CHECKPOINT_PREFIX = 'checkpoints/'
+
+# "fast" tagging stops a video once its counts settle or its compute budget is spent; "full" scans it all.
+# Set per upload with the scan-tier object metadata, otherwise DEFAULT_SCAN_TIER applies.
+DEFAULT_SCAN_TIER = os.environ.get('DEFAULT_SCAN_TIER', 'full')
+FAST_TAG_OPTIONS = {
+    'converge_seconds': float(os.environ.get('FAST_TAG_CONVERGE_SECONDS', '10')),
+    'compute_budget_seconds': float(os.environ.get('FAST_TAG_BUDGET_SECONDS', '60')),
+}
+
+# Raw detections are kept next to the user's files so tags can be recomputed without re-running the model
+SAVE_RAW_DETECTIONS = os.environ.get('SAVE_RAW_DETECTIONS', 'true').lower() == 'true'
+
+# Load and warm up the model during the Lambda init phase instead of on the first request
+if os.environ.get('WARM_START', 'true').lower() == 'true':
+    try:
+        warm_start()
+    except Exception as e:
+        print(f"Warm start failed, the model will load on first use: {e}")
+
+def s3_records(event):
+    # S3 notifications arrive directly or wrapped in SQS messages
+    for record in event['Records']:
+        if record.get('eventSource') == 'aws:sqs':
+            yield from json.loads(record['body']).get('Records', [])
+        else:
+            yield record
+
+def detections_key(user_id, item_id):
+    # Format: users/{user_id}/detections/{item_id}.npz (outside raw/ so it doesn't trigger detection)
+    return f"users/{user_id}/detections/{item_id}.npz"
+
+def upload_detections(bucket_name, user_id, item_id, detections_path):
+    if detections_path and os.path.exists(detections_path):
+        s3_client.upload_file(detections_path, bucket_name, detections_key(user_id, item_id))
+        os.remove(detections_path)
+
+def lambda_segment_runner(bucket_name, object_key):
+    def run(video_path, segments, options):
+        def invoke(segment):
+            response = lambda_client.invoke(
+                FunctionName=SEGMENT_WORKER_FUNCTION,
+                Payload=json.dumps({'segment_job': {
+                    'bucket': bucket_name,
+                    'key': object_key,
+                    'segment': segment,
+                    'options': options,
+                }})
+            )
+            payload = json.loads(response['Payload'].read())
+            if response.get('FunctionError') or payload.get('statusCode') != 200:
+                raise Exception(f"Segment worker failed: {payload}")
+            return {'species_counts': payload['species_counts'], 'report': payload['report']}
+
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            return list(executor.map(invoke, segments))
+
+    return run
+
+def handle_segment_job(job, job_dir):
+    # Worker side of the 'lambda' segment runner: one segment of a video already in S3
+    video_path = video_source(job['bucket'], job['key'], os.path.join(job_dir, os.path.basename(job['key'])))
+
+    result = segment_prediction(video_path, **job['segment'], **job['options'])
+    return {'statusCode': 200, 'species_counts': result['species_counts'], 'report': result['report']}
+
+def save_checkpoint(bucket_name, item_id, state):
+    s3_client.put_object(Bucket=bucket_name, Key=f"{CHECKPOINT_PREFIX}{item_id}.pkl", Body=pickle.dumps(state))
+
+def load_checkpoint(bucket_name, item_id):
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=f"{CHECKPOINT_PREFIX}{item_id}.pkl")
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return pickle.loads(response['Body'].read())
+
+def delete_checkpoint(bucket_name, item_id):
+    s3_client.delete_object(Bucket=bucket_name, Key=f"{CHECKPOINT_PREFIX}{item_id}.pkl")
+
+def continue_later(records, resume):
+    # Re-invoke this function asynchronously with the records that are left;
+    # resume lists the items with a checkpoint, the others start from scratch
+    lambda_client.invoke(
+        FunctionName=os.environ['AWS_LAMBDA_FUNCTION_NAME'],
+        InvocationType='Event',
+        Payload=json.dumps({'Records': records, 'resume': resume})
+    )
+
+def set_original_url(item_id, bucket_name, object_key):
+    dynamodb.update_item(
+        TableName=table_name,
+        Key={'id': {'S': item_id}},
+        UpdateExpression="SET original_url = :url",
+        ExpressionAttributeValues={':url': {'S': f'https://{bucket_name}.s3.ap-southeast-2.amazonaws.com/{object_key}'}}
+    )
+
+def finish_upload(bucket_name, object_key, item_id, digest):
+    # With shared objects on, the upload's bytes move to the one copy kept per content hash
+    if DEDUP_SHARED_OBJECTS:
+        move_to_shared(s3_client, digest, bucket_name, object_key,
+                       lambda shared_key: set_original_url(item_id, bucket_name, shared_key))
+
+def cached_result(digest):
+    # The content cache only saves a model run, a failing read never fails the record
+    try:
+        return lookup(digest, require_artifacts=SAVE_RAW_DETECTIONS)
+    except Exception as e:
+        print(f"Content cache lookup failed, running the model: {e}")
+        return None
+
+def reuse_result(cached, bucket_name, object_key, user_id, item_id, digest):
+    # An earlier upload had the same bytes: take its tags and raw detections instead of running the model
+    print(f"{item_id} has the same content as an earlier upload, reusing its tags")
+    update_tags(item_id, cached['file_type'], cached['tags'])
+    if SAVE_RAW_DETECTIONS and cached['detections_key']:
+        try:
+            s3_client.copy_object(
+                CopySource={'Bucket': bucket_name, 'Key': cached['detections_key']},
+                Bucket=bucket_name,
+                Key=detections_key(user_id, item_id)
+            )
+        except s3_client.exceptions.ClientError as e:
+            print(f"Couldn't copy the raw detections of the earlier upload: {e}")
+    finish_upload(bucket_name, object_key, item_id, digest)
+
+def remember_result(bucket_name, object_key, user_id, item_id, digest, file_type, species_counts):
+    # Best effort, the item's tags are already written
+    try:
+        store(digest, file_type, species_counts, detections_key(user_id, item_id) if SAVE_RAW_DETECTIONS else None)
+    except Exception as e:
+        print(f"Could not cache the tags of {object_key}: {e}")
+    finish_upload(bucket_name, object_key, item_id, digest)
+
+def finish_detection(bucket_name, object_key, user_id, item_id, digest, file_type, species_counts, detections_path,
+                     scan_report=None, remember=True):
+    # Only writing the tags can fail the record; the raw detections, cache and dedup steps after it are best effort
+    update_tags(item_id, file_type, species_counts, scan_report=scan_report)
+    try:
+        upload_detections(bucket_name, user_id, item_id, detections_path)
+    except Exception as e:
+        print(f"Couldn't upload the raw detections of {object_key}: {e}")
+        remember = False  # a cache row would point other uploads at detections that aren't there
+    if remember and digest:
+        remember_result(bucket_name, object_key, user_id, item_id, digest, file_type, species_counts)
+
+def update_tags(item_id, file_type, species_counts, detection_status='COMPLETE', scan_report=None):
+    # detection_status is PARTIAL while a checkpointed video is still being processed;
+    # scan_report records where and why a video scan stopped
+    if isinstance(species_counts, str):
+        species_counts = json.loads(species_counts)
+
+    expressions = ["detection_status = :status"]
+    values = {':status': {'S': detection_status}}
+
+    if scan_report and scan_report.get('stop_frame') is not None:
+        expressions.append("scan_stop_reason = :reason, scan_stop_frame = :frame")
+        values[':reason'] = {'S': scan_report['stop_reason']}
+        values[':frame'] = {'N': str(scan_report['stop_frame'])}
+
+    if species_counts:
+        expressions.append("file_type = :ftype, tags = :tags")
+        values[':ftype'] = {'S': file_type}
+        values[':tags'] = {'M': {k: {'N': str(v)} for k, v in species_counts.items()}}
+    else:
+        print(f"No birds detected for {item_id}")
+
+    # Update the item to DynamoDB
+    dynamodb.update_item(
+        TableName=table_name,
+        Key={'id': {'S': item_id}},
+        UpdateExpression="SET " + ", ".join(expressions),
+        ExpressionAttributeValues=values
+    )
+
+def mark_failed(item_id, error):
+    # The item keeps whatever tags it had; its counts from the failed run are not written
+    dynamodb.update_item(
+        TableName=table_name,
+        Key={'id': {'S': item_id}},
+        UpdateExpression="SET detection_status = :status, detection_error = :error",
+        ExpressionAttributeValues={':status': {'S': 'FAILED'}, ':error': {'S': str(error)[:1000]}}
+    )
+
+def record_failure(failed, object_key, item_id, error):
+    # One record failed, the others carry on
+    print(f"Error processing {object_key}: {error}")
+    failed[object_key] = str(error)
+    try:
+        mark_failed(item_id, error)
+    except Exception as e:
+        print(f"Couldn't mark {item_id} as failed: {e}")
+
+def discard_checkpoint(bucket_name, item_id):
+    # A leftover checkpoint is only never loaded again, so this doesn't fail the record
+    try:
+        delete_checkpoint(bucket_name, item_id)
+    except Exception as e:
+        print(f"Couldn't delete the checkpoint of {item_id}: {e}")
+
 def lambda_handler(event, context):
+    # Scratch space for this invocation, removed when it ends
+    job_dir = workspace.allocate(context.aws_request_id if context else None)
+
     try:
-        for record in event['Records']:
+        if 'segment_job' in event:
+            return handle_segment_job(event['segment_job'], job_dir)
+
+        # Images are collected and run through the model together once all records are downloaded
+        image_items = []
+        images = []
+        image_detections_paths = []
+        image_records = []
+
+        # object key -> error, for records that failed without stopping the others
+        failed = {}
+
+        # Videos checkpointed by an earlier invocation, only these have a checkpoint to load and delete
+        resumed = set(event.get('resume', []))
+
+        records = list(s3_records(event))
+        for i, record in enumerate(records):
             bucket_name = record['s3']['bucket']['name']
             object_key = record['s3']['object']['key']
             print(f"Triggered by: s3://{bucket_name}/{object_key}")
@@ -25,44 +258,110 @@ def lambda_handler(event, context):
             item_id, ext = os.path.splitext(filename)
             ext = ext.lower()
 
-            # Download the image from S3
-            tmp_path = f"/tmp/{filename}"
-            response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-            with open(tmp_path, 'wb') as f:
-                f.write(response['Body'].read())
+            if ext not in ['.jpg', '.jpeg', '.png', '.mp4', '.mov']:
+                print(f"Unsupported file type: {ext}")
+                continue
+
+            detections_path = os.path.join(job_dir, f"{item_id}.detections.npz") if SAVE_RAW_DETECTIONS else None
 
             # Check the file is image or video
             if ext in ['.jpg', '.jpeg', '.png']:
-                species_counts = image_prediction(tmp_path)
-                file_type = "image"
+                try:
+                    # Decode the image straight from the S3 bytes
+                    data = s3_client.get_object(Bucket=bucket_name, Key=object_key)['Body'].read()
+                    digest = sha256_bytes(data)
+                    cached = cached_result(digest)
+                    if cached:
+                        reuse_result(cached, bucket_name, object_key, user_id, item_id, digest)
+                        continue
+                    image = decode_image(data)
+                except Exception as e:
+                    record_failure(failed, object_key, item_id, e)
+                    continue
 
-            elif ext in ['.mp4', '.mov']:
-                species_counts = video_prediction(tmp_path)
-                file_type = "video"
+                image_items.append((bucket_name, object_key, user_id, item_id, digest))
+                images.append(image)
+                image_detections_paths.append(detections_path)
+                image_records.append(record)
 
             else:
-                raise ValueError(f"Unsupported file type: {ext}")
+                resume_state = None
+                try:
+                    resume_state = load_checkpoint(bucket_name, item_id) if item_id in resumed else None
+                    if resume_state is None:
+                        digest = sha256_object(s3_client, bucket_name, object_key)
+                        cached = cached_result(digest)
+                        if cached:
+                            reuse_result(cached, bucket_name, object_key, user_id, item_id, digest)
+                            continue
+                    else:
+                        digest = resume_state.get('content_hash')
 
-            if isinstance(species_counts, str):
-                species_counts = json.loads(species_counts)
+                    # Stream the video from S3 rather than staging it in /tmp
+                    video_path = video_source(bucket_name, object_key, os.path.join(job_dir, filename))
+                    metadata = s3_client.head_object(Bucket=bucket_name, Key=object_key).get('Metadata', {})
 
-            if not species_counts:
-                print(f"No birds detected for {filename}")
-                continue
-        
-                
-            # Update the item to DynamoDB
-            dynamodb.update_item(
-                TableName=table_name,
-                Key={'id': {'S': item_id}},
-                UpdateExpression="SET file_type = :ftype, tags = :tags",
-                ExpressionAttributeValues={
-                    ':ftype': {'S': file_type},
-                    ':tags': {'M': {k: {'N': str(v)} for k, v in species_counts.items()}}
-                }
-            )
+                    segment_runner = lambda_segment_runner(bucket_name, object_key) if VIDEO_SEGMENT_RUNNER == 'lambda' else None
+                    scan_tier = metadata.get('scan-tier', DEFAULT_SCAN_TIER)
+                    tier_options = FAST_TAG_OPTIONS if scan_tier == 'fast' else {}
+                    scan_report = {}
+                    species_counts = video_prediction(
+                        video_path,
+                        detections_path=detections_path,
+                        segment_runner=segment_runner,
+                        resume_state=resume_state,
+                        time_left=context.get_remaining_time_in_millis if context else None,
+                        report=scan_report,
+                        **tier_options
+                    )
+                except DeadlineReached as e:
+                    # Save progress and hand this video, the pending images and the remaining records to a new invocation
+                    print(f"{e}, continuing {item_id} in a new invocation")
+                    save_checkpoint(bucket_name, item_id, dict(e.state, content_hash=digest))
+                    update_tags(item_id, "video", e.state['max_species_counts'], detection_status='PARTIAL')
+                    continue_later(image_records + records[i:], resume=[item_id])
+                    images = []
+                    break
+                except Exception as e:
+                    # Never write the counts of an interrupted scan as if it had completed
+                    record_failure(failed, object_key, item_id, e)
+                    if resume_state is not None:
+                        discard_checkpoint(bucket_name, item_id)
+                    continue
+
+                if resume_state is not None:
+                    discard_checkpoint(bucket_name, item_id)
+                try:
+                    # Fast-tier counts are an estimate, only scans that reached the end are reused for other uploads
+                    # (in segment mode, only if every segment did)
+                    finish_detection(bucket_name, object_key, user_id, item_id, digest, "video", species_counts,
+                                     detections_path, scan_report=scan_report,
+                                     remember=scan_report.get('stop_reason', 'end_of_video') == 'end_of_video')
+                except Exception as e:
+                    record_failure(failed, object_key, item_id, e)
+
+        # The images collected above are tagged even when other records failed
+        if images:
+            print(f"Running batched detection on {len(images)} images")
+            try:
+                results = image_prediction_batch(images, detections_paths=image_detections_paths if SAVE_RAW_DETECTIONS else None)
+            except Exception as e:
+                print(f"Error running batched detection: {e}")
+                for _, object_key, _, item_id, _ in image_items:
+                    record_failure(failed, object_key, item_id, e)
+                results = []
+            for (bucket_name, object_key, user_id, item_id, digest), detections_path, species_counts in zip(image_items, image_detections_paths, results):
+                try:
+                    finish_detection(bucket_name, object_key, user_id, item_id, digest, "image", species_counts, detections_path)
+                except Exception as e:
+                    record_failure(failed, object_key, item_id, e)
+
+        if failed:
+            return {
+                "statusCode": 207,
+                "body": json.dumps({'failed': failed})
+            }
 
-            
         return {
             "statusCode": 200,
             "body": json.dumps("Bird detection completed")
@@ -73,4 +372,5 @@ def lambda_handler(event, context):
             "statusCode": 500,
             "body": json.dumps(f"Error: {str(e)}")
         }
-
+    finally:
+        workspace.release(job_dir)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Accuracy vs speed of the video frame sampling settings.
+# Usage: python compare_sampling.py <video> [<video> ...]
+# Every video is first scanned frame by frame; each sampling setting is then
+# compared against that full scan.
+
+import json
+import sys
+import time
+
+from bird_detection import load_model, video_prediction
+
+SETTINGS = {
+    'full': {},
+    'stride_2': {'frame_stride': 2},
+    'stride_5': {'frame_stride': 5},
+    'target_5fps': {'target_fps': 5},
+    'target_2fps': {'target_fps': 2},
+    'adaptive_stride_5': {'frame_stride': 5, 'adaptive_sampling': True},
+}
+
+
+def compare(full_counts, counts):
+    species = set(full_counts) | set(counts)
+    return {
+        'species_match': set(full_counts) == set(counts),
+        'count_abs_error': sum(abs(full_counts.get(s, 0) - counts.get(s, 0)) for s in species),
+    }
+
+
+def main(video_paths):
+    load_model()  # keep model loading out of the timings
+    report = []
+
+    for video_path in video_paths:
+        full_counts = None
+        for name, kwargs in SETTINGS.items():
+            started = time.perf_counter()
+            counts = json.loads(video_prediction(video_path, **kwargs))
+            elapsed = time.perf_counter() - started
+
+            if full_counts is None:
+                full_counts, full_elapsed = counts, elapsed
+
+            row = {
+                'video': video_path,
+                'setting': name,
+                'seconds': round(elapsed, 2),
+                'speedup': round(full_elapsed / elapsed, 2) if elapsed else None,
+                'counts': counts,
+            }
+            row.update(compare(full_counts, counts))
+            report.append(row)
+            print(json.dumps(row))
+
+    return report
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python compare_sampling.py <video> [<video> ...]")
+        sys.exit(1)
+    main(sys.argv[1:])
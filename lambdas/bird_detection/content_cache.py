@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Content-addressed cache of detection results. Files are identified by the
+# SHA-256 of their bytes, so a re-uploaded photo, clip or recording (or a
+# content search with a file that was already tagged) reuses the stored tags
+# instead of running YOLO or BirdNET again.
+# Keep the copies in every Lambda folder identical.
+#
+# Table (partition key content_hash, string) rows:
+#   {CONTENT_CACHE_VERSION}#{sha256}  file_type, tags, detections_key
+#   object#{sha256}                   shared_key, refs (DEDUP_SHARED_OBJECTS only)
+
+import base64
+import hashlib
+import json
+import os
+import uuid
+
+import boto3
+
+CONTENT_CACHE = os.environ.get('CONTENT_CACHE', 'true').lower() == 'true'
+CONTENT_HASH_TABLE = os.environ.get('CONTENT_HASH_TABLE', 'birdtag_content_hashes')
+CONTENT_CACHE_VERSION = os.environ.get('CONTENT_CACHE_VERSION', '1')  # bump when the model or its settings change
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Keep the bytes of duplicate uploads once, under content/{sha256}/{generation}{ext}
+DEDUP_SHARED_OBJECTS = os.environ.get('DEDUP_SHARED_OBJECTS', 'false').lower() == 'true'
+SHARED_PREFIX = 'content/'
+SHARE_ATTEMPTS = 5  # reads of the shared-object row before share_object gives up on a racing release
+
+dynamodb = boto3.client('dynamodb')
+
+
+## Hashing
+def sha256_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def s3_checksum(s3_client, bucket_name, object_key):
+    # The SHA-256 S3 stored for the whole object, if the upload sent one
+    # (multipart uploads without a full-object checksum only have a checksum of the parts)
+    head = s3_client.head_object(Bucket=bucket_name, Key=object_key, ChecksumMode='ENABLED')
+    checksum = head.get('ChecksumSHA256')
+    if checksum and '-' not in checksum and head.get('ChecksumType', 'FULL_OBJECT') == 'FULL_OBJECT':
+        return base64.b64decode(checksum).hex()
+    return None
+
+
+def sha256_object(s3_client, bucket_name, object_key):
+    # S3's own checksum when there is one, otherwise a streaming hash of the object
+    checksum = s3_checksum(s3_client, bucket_name, object_key)
+    if checksum:
+        return checksum
+
+    digest = hashlib.sha256()
+    body = s3_client.get_object(Bucket=bucket_name, Key=object_key)['Body']
+    for chunk in body.iter_chunks(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+## Results
+def result_key(digest):
+    return {'content_hash': {'S': f"{CONTENT_CACHE_VERSION}#{digest}"}}
+
+
+def lookup(digest, require_artifacts=False):
+    # The stored result for these bytes, or None. With require_artifacts a row without a
+    # detections/scores key (written before an upload saved them) is a miss, so the upload
+    # runs the model and its store() fills them in
+    if not CONTENT_CACHE:
+        return None
+
+    item = dynamodb.get_item(TableName=CONTENT_HASH_TABLE, Key=result_key(digest)).get('Item')
+    if not item or 'tags' not in item:
+        return None
+    if require_artifacts and 'detections_key' not in item:
+        return None
+
+    return {
+        'file_type': item['file_type']['S'],
+        'tags': {k: int(v['N']) for k, v in item['tags']['M'].items()},
+        'detections_key': item.get('detections_key', {}).get('S'),
+    }
+
+
+def store(digest, file_type, species_counts, detections_key=None):
+    if not CONTENT_CACHE:
+        return
+    if isinstance(species_counts, str):
+        species_counts = json.loads(species_counts)
+
+    item = {
+        **result_key(digest),
+        'file_type': {'S': file_type},
+        'tags': {'M': {k: {'N': str(v)} for k, v in species_counts.items()}},
+    }
+    if detections_key:
+        item['detections_key'] = {'S': detections_key}
+    dynamodb.put_item(TableName=CONTENT_HASH_TABLE, Item=item)
+
+
+## Shared objects
+def object_key_for(digest):
+    return {'content_hash': {'S': f"object#{digest}"}}
+
+
+def share_object(s3_client, digest, bucket_name, object_key):
+    """
+    Copies an upload to content/{sha256}/{generation}{ext}, where every
+    upload with the same bytes shares one copy, and returns the shared key.
+    The row counts the uploads referencing the copy, see release_object(). A
+    reference is only counted once the copy exists, so a failed copy never
+    leaves a row pointing at a missing object, and every new copy gets a new
+    generation, so releasing the last reference to an old copy can never
+    delete a newer one. The caller deletes the upload once its item points at
+    the shared copy.
+    """
+    for _ in range(SHARE_ATTEMPTS):
+        # The copy already exists, take a reference unless its last one was released meanwhile
+        row = dynamodb.get_item(TableName=CONTENT_HASH_TABLE, Key=object_key_for(digest), ConsistentRead=True).get('Item')
+        if row:
+            shared_key = row['shared_key']['S']
+            try:
+                dynamodb.update_item(
+                    TableName=CONTENT_HASH_TABLE,
+                    Key=object_key_for(digest),
+                    UpdateExpression="ADD refs :one",
+                    ConditionExpression="shared_key = :key",
+                    ExpressionAttributeValues={':key': {'S': shared_key}, ':one': {'N': '1'}}
+                )
+                return shared_key
+            except dynamodb.exceptions.ConditionalCheckFailedException:
+                continue
+
+        # First upload with these bytes: copy, then create the row counting the reference
+        shared_key = f"{SHARED_PREFIX}{digest}/{uuid.uuid4().hex}{os.path.splitext(object_key)[1].lower()}"
+        s3_client.copy_object(CopySource={'Bucket': bucket_name, 'Key': object_key}, Bucket=bucket_name, Key=shared_key)
+        try:
+            dynamodb.put_item(
+                TableName=CONTENT_HASH_TABLE,
+                Item={**object_key_for(digest), 'shared_key': {'S': shared_key}, 'refs': {'N': '1'}},
+                ConditionExpression="attribute_not_exists(content_hash)"
+            )
+            return shared_key
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            # A racing upload created its copy first, use that one
+            s3_client.delete_object(Bucket=bucket_name, Key=shared_key)
+
+    raise RuntimeError(f"Couldn't share {object_key}, the shared copy kept changing")
+
+
+def move_to_shared(s3_client, digest, bucket_name, object_key, set_url):
+    # Best effort dedup of one upload: share its bytes, point its item at the shared copy with
+    # set_url(shared_key), then delete the upload. Any failure leaves the item on its own copy.
+    try:
+        shared_key = share_object(s3_client, digest, bucket_name, object_key)
+    except Exception as e:
+        print(f"Couldn't share the content of {object_key}, it keeps its own copy: {e}")
+        return
+    try:
+        set_url(shared_key)
+    except Exception as e:
+        print(f"Couldn't point {object_key} at {shared_key}, it keeps its own copy: {e}")
+        try:
+            release_object(s3_client, bucket_name, shared_key)
+        except Exception as e:
+            print(f"Couldn't release {shared_key}: {e}")
+        return
+    try:
+        s3_client.delete_object(Bucket=bucket_name, Key=object_key)
+    except Exception as e:
+        print(f"Couldn't delete {object_key} after sharing it: {e}")
+
+
+def release_object(s3_client, bucket_name, shared_key):
+    # Drops one reference to a shared copy and deletes it with the last one
+    name = shared_key[len(SHARED_PREFIX):]
+    digest = os.path.splitext(name.split('/', 1)[0])[0]  # content/{sha256}/{generation}{ext}, or content/{sha256}{ext}
+    try:
+        response = dynamodb.update_item(
+            TableName=CONTENT_HASH_TABLE,
+            Key=object_key_for(digest),
+            UpdateExpression="ADD refs :minus_one",
+            ConditionExpression="shared_key = :key",
+            ExpressionAttributeValues={':key': {'S': shared_key}, ':minus_one': {'N': '-1'}},
+            ReturnValues='UPDATED_NEW'
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        print(f"{shared_key} is no longer referenced")
+        return
+    if int(response['Attributes']['refs']['N']) > 0:
+        return
+
+    # Only delete the copy if no upload took a new reference in the meantime. Later uploads
+    # with these bytes get a copy under a new generation, so this key is never reused.
+    try:
+        dynamodb.delete_item(
+            TableName=CONTENT_HASH_TABLE,
+            Key=object_key_for(digest),
+            ConditionExpression="refs <= :zero AND shared_key = :key",
+            ExpressionAttributeValues={':zero': {'N': '0'}, ':key': {'S': shared_key}}
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return
+    s3_client.delete_object(Bucket=bucket_name, Key=shared_key)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Thread settings sized to the vCPUs the Lambda actually gets for its memory
+# setting (cgroup CPU quota and CPU affinity), for torch, OpenCV and BirdNET.
+# Keep the copies in every Lambda folder identical.
+#
+# Sweep mode runs a command once per thread count and records its throughput:
+#   python cpu_threads.py --sweep 1,2,4,6 --repeat 3 --output sweep.json -- \
+#       python3 -m birdnet_analyzer.analyze sample.wav --threads {threads}
+# {threads} in the command is replaced by the thread count, which is also
+# passed to the command as CPU_THREADS.
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+CPU_THREADS = int(os.environ.get('CPU_THREADS', '0'))  # 0 sizes the thread pools from the CPU quota
+
+# Read by the OpenMP/BLAS pools of numpy, torch and TensorFlow when they start
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+# Thread count applied by configure_threads, None until it first runs
+configured_threads = None
+
+
+def read_first_line(path):
+    with open(path) as f:
+        return f.readline().strip()
+
+
+def cgroup_cpu_quota():
+    # CPUs allowed by the cgroup CPU quota, None when there is no quota
+    try:
+        quota, period = read_first_line(CGROUP_V2_CPU_MAX).split()[:2]
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        quota = int(read_first_line(CGROUP_V1_QUOTA))
+        period = int(read_first_line(CGROUP_V1_PERIOD))
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = os.cpu_count() or 1
+
+    quota = cgroup_cpu_quota()
+    if quota:
+        # A partial vCPU still runs a thread part of the time
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def thread_count(workers=1):
+    # Threads for each of `workers` processes sharing the container's CPUs
+    cpus = CPU_THREADS or available_cpus()
+    return max(1, cpus // max(1, workers))
+
+
+def configure_threads(threads=None):
+    """
+    Sizes the thread pools of the libraries already imported in this process
+    (torch intra-op and inter-op, OpenCV) and the OpenMP/BLAS variables seen
+    by later imports and subprocesses. Without `threads`, the count from an
+    earlier call is kept, otherwise it comes from thread_count(). Logs and
+    returns the chosen configuration.
+    """
+    global configured_threads
+
+    if threads is None:
+        threads = configured_threads or thread_count()
+
+    config = {'threads': threads, 'cpus': available_cpus(), 'cgroup_quota': cgroup_cpu_quota()}
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(threads)
+        except RuntimeError:
+            pass  # fixed once torch has run parallel work
+        config['torch_intra_op'] = torch.get_num_threads()
+        config['torch_inter_op'] = torch.get_num_interop_threads()
+
+    cv = sys.modules.get('cv2')
+    if cv is not None:
+        cv.setNumThreads(threads)
+        config['opencv'] = cv.getNumThreads()
+
+    configured_threads = threads
+    print(f"Thread configuration: {json.dumps(config)}")
+    return config
+
+
+## Sweep mode
+def sweep(command, thread_counts, repeat=1):
+    results = []
+    for threads in thread_counts:
+        env = os.environ.copy()
+        env['CPU_THREADS'] = str(threads)
+        args = [arg.replace('{threads}', str(threads)) for arg in command]
+
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run(args, env=env, check=True, stdout=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - started)
+
+        best = min(timings)
+        results.append({
+            'threads': threads,
+            'seconds': [round(t, 3) for t in timings],
+            'runs_per_minute': round(60 / best, 2),
+        })
+        print(f"{threads} threads: best {best:.2f}s of {repeat}")
+
+    baseline = results[0]['runs_per_minute']
+    for result in results:
+        result['speedup'] = round(result['runs_per_minute'] / baseline, 2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep thread counts for a command and record throughput")
+    parser.add_argument('--sweep', default=None, help="comma separated thread counts, default 1 up to the available CPUs")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        parser.error("no command to sweep")
+
+    if args.sweep:
+        thread_counts = [int(n) for n in args.sweep.split(',')]
+    else:
+        thread_counts = list(range(1, available_cpus() + 1))
+
+    report = {
+        'command': command,
+        'cpus': available_cpus(),
+        'cgroup_quota': cgroup_cpu_quota(),
+        'results': sweep(command, thread_counts, args.repeat),
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Import-time report for the detection modules, with a budget check.
+# Runs `python -X importtime -c "import <module>"` in a fresh interpreter,
+# summarises the slowest top-level packages and exits 1 if the total import
+# time of any module is over budget.
+#
+# Usage (from the folder that holds the module):
+#   python import_budget.py bird_detection bird_detection_lambda
+#   python import_budget.py --budget-ms 800 --top 15 lambda_handler
+
+import argparse
+import os
+import subprocess
+import sys
+
+DEFAULT_BUDGET_MS = 1000
+
+
+def import_times(module):
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(), env.get('PYTHONPATH')]))
+    env['WARM_START'] = 'false'  # the handlers would otherwise load the model on import
+
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr}")
+
+    # Lines look like: "import time:       self [us] |  cumulative | imported package"
+    packages = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only top-level entries, nested imports are indented
+        if name.startswith('  '):
+            continue
+        packages[name.strip()] = int(cumulative) / 1000
+    return packages
+
+
+def report(module, budget_ms, top):
+    packages = import_times(module)
+    total_ms = packages.get(module, sum(packages.values()))
+
+    print(f"{module}: {total_ms:.0f} ms (budget {budget_ms} ms)")
+    for name, ms in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"  {ms:8.1f} ms  {name}")
+
+    return total_ms <= budget_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time report with a budget check")
+    parser.add_argument('modules', nargs='+')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    within_budget = [report(module, args.budget_ms, args.top) for module in args.modules]
+    if not all(within_budget):
+        print("Import time budget exceeded")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
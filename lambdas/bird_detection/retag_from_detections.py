@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Recomputes the tags of every processed file from its saved raw detections
+# (users/{user_id}/detections/{item_id}.npz) for a new confidence threshold or
+# counting rule, without running the model again.
+#
+# Usage: python retag_from_detections.py --confidence 0.4 [--rule max_per_frame] [--dry-run]
+
+import argparse
+import io
+import os
+
+import boto3
+
+from bird_detection import COUNTING_RULES, recompute_tags
+
+bucket_name = 'birdtag-cloud170'
+table_name = 'birdtag_location'
+s3_client = boto3.client('s3')
+dynamodb = boto3.client('dynamodb')
+
+
+def detection_files():
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix='users/'):
+        for obj in page.get('Contents', []):
+            parts = obj['Key'].split('/')
+            if len(parts) == 4 and parts[2] == 'detections' and parts[3].endswith('.npz'):
+                yield obj['Key']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute tags from saved raw detections")
+    parser.add_argument('--confidence', type=float, default=0.3)
+    parser.add_argument('--rule', choices=COUNTING_RULES, default='max_per_frame')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    for key in detection_files():
+        item_id = os.path.splitext(key.split('/')[3])[0]
+        body = s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+        species_counts = recompute_tags(io.BytesIO(body), confidence=args.confidence, rule=args.rule)
+        print(f"{item_id}: {species_counts}")
+
+        if args.dry_run:
+            continue
+
+        dynamodb.update_item(
+            TableName=table_name,
+            Key={'id': {'S': item_id}},
+            UpdateExpression="SET tags = :tags",
+            ExpressionAttributeValues={
+                ':tags': {'M': {k: {'N': str(v)} for k, v in species_counts.items()}}
+            }
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+# Tests import the Lambda's modules the way the runtime does, from the function's folder.
+# Run with: python -m pytest lambdas/bird_detection/tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# boto3 clients are created at import time and need a region, no request is made
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-southeast-2')
+os.environ.setdefault('WARM_START', 'false')
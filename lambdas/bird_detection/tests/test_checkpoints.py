@@ -0,0 +1,58 @@
+import json
+import pickle
+from types import SimpleNamespace
+
+import pytest
+
+import bird_detection
+from test_video_segments import detect_squares, write_video
+
+BUCKET = 'birdtag-test'
+
+
+@pytest.fixture
+def squares(tmp_path, monkeypatch):
+    cv = pytest.importorskip('cv2')
+    pytest.importorskip('supervision')
+
+    monkeypatch.setattr(bird_detection, 'load_model', lambda *args: SimpleNamespace(names={0: 'Red', 1: 'Blue'}))
+    monkeypatch.setattr(bird_detection, 'run_model', detect_squares)
+    return write_video(cv, tmp_path / 'squares.mp4')
+
+
+def test_a_video_checkpointed_after_every_batch_resumes_to_the_serial_counts(squares):
+    serial = json.loads(bird_detection.video_prediction(squares, segments=1, batch_size=8))
+
+    # No time left: every invocation scans one batch and checkpoints
+    state, checkpoints = None, []
+    while True:
+        try:
+            counts = json.loads(bird_detection.video_prediction(
+                squares, segments=1, resume_state=state, time_left=lambda: 0, batch_size=8))
+            break
+        except bird_detection.DeadlineReached as e:
+            state = pickle.loads(pickle.dumps(e.state))  # stored the way save_checkpoint does
+            checkpoints.append(state['next_frame'])
+
+    assert checkpoints[:3] == [8, 16, 24] and len(checkpoints) >= 11
+    assert counts == serial == {'red': 3, 'blue': 2}
+
+
+def test_checkpoints_round_trip_through_s3(monkeypatch):
+    moto = pytest.importorskip('moto')
+    import boto3
+    import bird_detection_lambda
+
+    with moto.mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': 'ap-southeast-2'})
+        monkeypatch.setattr(bird_detection_lambda, 's3_client', s3)
+
+        assert bird_detection_lambda.load_checkpoint(BUCKET, 'clip') is None
+
+        state = {'next_frame': 8, 'max_species_counts': {'magpie': 2}, 'content_hash': 'abc'}
+        bird_detection_lambda.save_checkpoint(BUCKET, 'clip', state)
+        assert bird_detection_lambda.load_checkpoint(BUCKET, 'clip') == state
+
+        bird_detection_lambda.discard_checkpoint(BUCKET, 'clip')
+        assert bird_detection_lambda.load_checkpoint(BUCKET, 'clip') is None
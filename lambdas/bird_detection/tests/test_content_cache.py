@@ -0,0 +1,138 @@
+import pytest
+
+moto = pytest.importorskip('moto')
+
+import boto3
+
+import content_cache
+
+BUCKET = 'birdtag-test'
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    with moto.mock_aws():
+        dynamodb = boto3.client('dynamodb')
+        dynamodb.create_table(
+            TableName=content_cache.CONTENT_HASH_TABLE,
+            KeySchema=[{'AttributeName': 'content_hash', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'content_hash', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': 'ap-southeast-2'})
+        monkeypatch.setattr(content_cache, 'dynamodb', dynamodb)
+        monkeypatch.setattr(content_cache, 'CONTENT_CACHE', True)
+        yield s3
+
+
+def keys(s3):
+    return sorted(obj['Key'] for obj in s3.list_objects_v2(Bucket=BUCKET).get('Contents', []))
+
+
+def upload(s3, key, data=b'bird'):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=data)
+    return key
+
+
+## lookup/store
+def test_lookup_returns_what_store_wrote(aws):
+    content_cache.store('abc', 'image', {'magpie': 2}, 'users/u/detections/1.npz')
+    assert content_cache.lookup('abc') == {
+        'file_type': 'image', 'tags': {'magpie': 2}, 'detections_key': 'users/u/detections/1.npz'}
+    assert content_cache.lookup('other') is None
+
+
+def test_rows_without_artifacts_only_miss_when_they_are_required(aws):
+    content_cache.store('abc', 'video', '{"wren": 1}')
+    assert content_cache.lookup('abc')['tags'] == {'wren': 1}
+    assert content_cache.lookup('abc', require_artifacts=True) is None
+
+
+def test_a_new_cache_version_misses_old_rows(aws, monkeypatch):
+    content_cache.store('abc', 'image', {'magpie': 2})
+    monkeypatch.setattr(content_cache, 'CONTENT_CACHE_VERSION', '2')
+    assert content_cache.lookup('abc') is None
+
+
+## Shared objects
+def test_uploads_with_the_same_bytes_share_one_copy(aws):
+    first = content_cache.share_object(aws, 'abc', BUCKET, upload(aws, 'users/u/raw/1.jpg'))
+    second = content_cache.share_object(aws, 'abc', BUCKET, upload(aws, 'users/v/raw/2.jpg'))
+
+    assert first == second and first.startswith('content/abc/') and first.endswith('.jpg')
+    assert aws.get_object(Bucket=BUCKET, Key=first)['Body'].read() == b'bird'
+    # The uploads are the caller's to delete
+    assert keys(aws) == sorted([first, 'users/u/raw/1.jpg', 'users/v/raw/2.jpg'])
+
+
+def test_the_copy_goes_with_its_last_reference(aws):
+    shared_key = content_cache.share_object(aws, 'abc', BUCKET, upload(aws, 'users/u/raw/1.jpg'))
+    content_cache.share_object(aws, 'abc', BUCKET, upload(aws, 'users/v/raw/2.jpg'))
+
+    content_cache.release_object(aws, BUCKET, shared_key)
+    assert shared_key in keys(aws)
+    content_cache.release_object(aws, BUCKET, shared_key)
+    assert shared_key not in keys(aws)
+
+    # A second release of the same key finds nothing to drop
+    content_cache.release_object(aws, BUCKET, shared_key)
+    assert content_cache.dynamodb.scan(TableName=content_cache.CONTENT_HASH_TABLE)['Items'] == []
+
+
+def test_a_failed_copy_counts_no_reference(aws):
+    with pytest.raises(Exception):
+        content_cache.share_object(aws, 'abc', BUCKET, 'users/u/raw/missing.jpg')
+    assert content_cache.dynamodb.scan(TableName=content_cache.CONTENT_HASH_TABLE)['Items'] == []
+
+
+def test_releasing_an_old_copy_keeps_a_newer_one(aws, monkeypatch):
+    old_key = content_cache.share_object(aws, 'abc', BUCKET, upload(aws, 'users/u/raw/1.jpg'))
+
+    # The release drops the last reference and its row, then a new upload shares the same bytes
+    # before the release gets to delete the old copy
+    delete_object = aws.delete_object
+    new_keys = []
+
+    def share_then_delete(Bucket, Key):
+        if Key == old_key and not new_keys:
+            new_keys.append(content_cache.share_object(aws, 'abc', BUCKET, upload(aws, 'users/v/raw/2.jpg')))
+        return delete_object(Bucket=Bucket, Key=Key)
+
+    monkeypatch.setattr(aws, 'delete_object', share_then_delete)
+    content_cache.release_object(aws, BUCKET, old_key)
+
+    assert new_keys[0] != old_key
+    assert old_key not in keys(aws) and new_keys[0] in keys(aws)
+
+
+def test_move_to_shared_points_the_item_at_the_copy_before_deleting_the_upload(aws):
+    key = upload(aws, 'users/u/raw/1.jpg')
+    pointed = []
+
+    def set_url(shared_key):
+        assert key in keys(aws)
+        pointed.append(shared_key)
+
+    content_cache.move_to_shared(aws, 'abc', BUCKET, key, set_url)
+    assert keys(aws) == pointed
+
+
+def test_move_to_shared_keeps_the_upload_when_the_item_cannot_be_updated(aws):
+    key = upload(aws, 'users/u/raw/1.jpg')
+
+    def set_url(shared_key):
+        raise RuntimeError("throttled")
+
+    content_cache.move_to_shared(aws, 'abc', BUCKET, key, set_url)
+    assert keys(aws) == [key]
+    assert content_cache.dynamodb.scan(TableName=content_cache.CONTENT_HASH_TABLE)['Items'] == []
+
+
+def test_old_style_keys_are_still_released(aws):
+    shared_key = upload(aws, 'content/abc.jpg')
+    content_cache.dynamodb.put_item(TableName=content_cache.CONTENT_HASH_TABLE, Item={
+        'content_hash': {'S': 'object#abc'}, 'shared_key': {'S': shared_key}, 'refs': {'N': '1'}})
+
+    content_cache.release_object(aws, BUCKET, shared_key)
+    assert keys(aws) == []
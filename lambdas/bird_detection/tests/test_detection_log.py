@@ -0,0 +1,71 @@
+import io
+
+import numpy as np
+import pytest
+
+from bird_detection import DetectionLog, recompute_tags
+
+
+class Detections:
+    """The fields DetectionLog.add reads from a supervision Detections."""
+
+    def __init__(self, class_id, confidence, tracker_id=None):
+        self.class_id = np.array(class_id)
+        self.confidence = np.array(confidence, dtype=np.float32)
+        self.tracker_id = None if tracker_id is None else np.array(tracker_id)
+        self.xyxy = np.zeros((len(class_id), 4), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.class_id)
+
+
+@pytest.fixture
+def video_log():
+    # Class 0 is Magpie, 1 is Wren
+    log = DetectionLog({0: 'Magpie', 1: 'Wren'}, 'video')
+    log.add(0, Detections([0, 0, 1], [0.9, 0.9, 0.2], [1, 2, 3]))
+    log.add(1, Detections([0, 0, 0, 1], [0.9, 0.5, 0.35, 0.6], [1, 4, 5, 3]))
+    log.add(2, Detections([], []))
+
+    f = io.BytesIO()
+    log.save(f)
+    f.seek(0)
+    return f
+
+
+def test_max_per_frame_matches_the_live_count(video_log):
+    assert recompute_tags(video_log, confidence=0.3) == {'magpie': 3, 'wren': 1}
+
+
+def test_a_higher_threshold_drops_weak_detections(video_log):
+    assert recompute_tags(video_log, confidence=0.4) == {'magpie': 2, 'wren': 1}
+    video_log.seek(0)
+    assert recompute_tags(video_log, confidence=0.7) == {'magpie': 2}
+
+
+def test_unique_tracks_counts_each_tracked_bird_once(video_log):
+    assert recompute_tags(video_log, confidence=0.3, rule='unique_tracks') == {'magpie': 4, 'wren': 1}
+
+
+def test_presence_counts_each_species_once(video_log):
+    assert recompute_tags(video_log, confidence=0.3, rule='presence') == {'magpie': 1, 'wren': 1}
+
+
+def test_untracked_image_detections_count_once_each(tmp_path):
+    log = DetectionLog({0: 'Magpie'}, 'image')
+    log.add(0, Detections([0, 0, 0], [0.9, 0.8, 0.1]))
+    path = tmp_path / 'image.npz'
+    log.save(path)
+
+    assert recompute_tags(path, confidence=0.3, rule='unique_tracks') == {'magpie': 2}
+
+
+def test_an_empty_log_has_no_tags(tmp_path):
+    path = tmp_path / 'empty.npz'
+    DetectionLog({0: 'Magpie'}, 'video').save(path)
+    assert recompute_tags(path) == {}
+
+
+def test_unknown_rule(video_log):
+    with pytest.raises(ValueError):
+        recompute_tags(video_log, rule='median')
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+import bird_detection
+from bird_detection import queue_limit
+
+
+## queue_limit
+def test_queues_share_the_memory_ceiling():
+    frame_bytes = 1920 * 1080 * 3
+    assert queue_limit(frame_bytes, 16, 256, 1) == 16
+    assert queue_limit(frame_bytes, 16, 256, 4) == 10
+    assert queue_limit(frame_bytes, 16, 1, 4) == 1
+    assert queue_limit(0, 16, 1, 4) == 16  # frame size unknown
+
+
+## FrameReader
+def write_video(cv, path, frames=40):
+    writer = cv.VideoWriter(str(path), cv.VideoWriter_fourcc(*'mp4v'), 10, (320, 240))
+    for _ in range(frames):
+        writer.write(np.full((240, 320, 3), 128, dtype=np.uint8))
+    writer.release()
+    return str(path)
+
+
+def test_reader_queues_hold_no_more_than_the_ceiling(tmp_path):
+    cv = pytest.importorskip('cv2')
+    path = write_video(cv, tmp_path / 'grey.mp4')
+
+    reader = bird_detection.FrameReader(path, queue_size=16, decoder_threads=2, max_queue_mb=1)
+    try:
+        assert reader.queue_size == 2  # 1 MB over two queues of 230 KB frames
+        assert all(q.maxsize == 2 for q in reader.queues)
+        assert [index for index, _ in reader] == list(range(40))
+    finally:
+        reader.close()
@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import pytest
+
+import bird_detection
+from bird_detection import ADAPTIVE_READ_AHEAD, ADAPTIVE_STATIC_FRAMES, FrameSampler
+
+
+## FrameSampler
+def test_fixed_stride_keeps_every_nth_frame():
+    sampler = FrameSampler(25, stride=3, target_fps=0, adaptive=False)
+    assert [i for i in range(10) if sampler.keep(i)] == [0, 3, 6, 9]
+
+
+def test_target_fps_sets_the_stride():
+    sampler = FrameSampler(25, stride=1, target_fps=5, adaptive=False)
+    assert sampler.base_stride == 5
+    assert sampler.tracker_frame_rate(25) == 5
+
+
+def test_fixed_stride_ignores_count_changes():
+    sampler = FrameSampler(25, stride=2, target_fps=0, adaptive=False)
+    for counts in [{'magpie': 1}, {'magpie': 2}, {}, {'wren': 1}]:
+        sampler.update(counts)
+    assert sampler.stride == 2
+    assert sampler.stats()['analysed_frames'] == 4
+
+
+def test_adaptive_stride_halves_on_change_and_doubles_when_static():
+    sampler = FrameSampler(25, stride=4, target_fps=0, adaptive=True)
+
+    for _ in range(ADAPTIVE_STATIC_FRAMES):
+        sampler.update({'magpie': 1})
+    assert sampler.stride == 8
+
+    sampler.update({'magpie': 2})
+    assert sampler.stride == 4
+
+
+def test_adaptive_stride_stays_between_one_and_one_frame_per_second():
+    sampler = FrameSampler(25, stride=2, target_fps=0, adaptive=True)
+
+    for count in range(10):
+        sampler.update({'magpie': count})
+    assert sampler.stride == 1
+
+    for _ in range(ADAPTIVE_STATIC_FRAMES * 10):
+        sampler.update({'magpie': 0})
+    assert sampler.stride == 25
+
+
+def test_adaptive_tracker_rate_is_for_the_coarsest_stride():
+    sampler = FrameSampler(25, stride=2, target_fps=0, adaptive=True)
+    assert sampler.tracker_frame_rate(25) == 1
+    assert FrameSampler(25, stride=2, target_fps=0, adaptive=False).tracker_frame_rate(25) == 12
+
+
+def test_adaptive_sampling_keeps_the_read_ahead_short(monkeypatch):
+    pytest.importorskip('supervision')
+    queue_sizes = []
+
+    class Reader:
+        def __init__(self, video_path, queue_size, **kwargs):
+            queue_sizes.append(queue_size)
+
+        def __iter__(self):
+            return iter([])
+
+        def close(self):
+            pass
+
+        def stats(self):
+            return {}
+
+    monkeypatch.setattr(bird_detection, 'FrameReader', Reader)
+    monkeypatch.setattr(bird_detection, 'load_model', lambda *args: SimpleNamespace(names={}))
+    for adaptive in (False, True):
+        bird_detection.scan_video('clip.mp4', 25, {}, queue_size=64, adaptive_sampling=adaptive)
+    assert queue_sizes == [64, ADAPTIVE_READ_AHEAD]
@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import bird_detection
+from bird_detection import crop_imgsz, input_pixels, merge_boxes
+
+
+## merge_boxes
+def test_disjoint_and_touching_boxes_stay_apart():
+    boxes = [(0, 0, 10, 10), (10, 0, 20, 10), (50, 50, 60, 60)]
+    assert sorted(merge_boxes(boxes)) == sorted(boxes)
+
+
+def test_overlapping_boxes_become_their_union():
+    assert merge_boxes([(0, 0, 10, 10), (5, 5, 20, 15)]) == [(0, 0, 20, 15)]
+
+
+def test_boxes_joined_through_a_merged_box_are_merged():
+    # The first and last boxes only overlap once the middle one has grown the first
+    boxes = [(0, 0, 10, 10), (30, 0, 40, 10), (8, 0, 32, 10)]
+    assert merge_boxes(boxes) == [(0, 0, 40, 10)]
+
+
+def test_no_boxes():
+    assert merge_boxes([]) == []
+
+
+## Motion crops
+def test_crops_run_at_their_own_size_without_upscaling():
+    assert crop_imgsz(np.zeros((160, 200, 3)), 640) == 192
+    assert crop_imgsz(np.zeros((900, 1200, 3)), 640) == 640
+    assert input_pixels((1080, 1920, 3), 640) == 640 * 384
+
+
+def test_motion_crops_cost_fewer_pixels_than_the_frames(monkeypatch):
+    pytest.importorskip('supervision')
+    calls = []
+
+    def record(model, images, cascade=False, imgsz=None):
+        calls.append((images, imgsz or 640))
+        return [bird_detection.sv.Detections.empty() for _ in images]
+
+    class Gate:
+        full_frames = 0
+
+        def regions(self, frame):
+            if frame[0, 0, 0]:  # busy frame: its crops would cost more than the frame
+                return [(0, 0, 900, 1080), (1000, 0, 1920, 1080)]
+            return [(100, 100, 300, 260), (1500, 800, 1660, 960)]
+
+    monkeypatch.setattr(bird_detection, 'run_model', record)
+    model = SimpleNamespace(overrides={'imgsz': 640})
+    quiet = np.zeros((1080, 1920, 3), dtype=np.uint8)
+    busy = np.ones((1080, 1920, 3), dtype=np.uint8)
+    gate = Gate()
+
+    detections = bird_detection.detect_batch(model, [quiet, busy, quiet], gate)
+
+    assert len(detections) == 3 and gate.full_frames == 1
+    pixels = sum(input_pixels(image.shape, imgsz) for images, imgsz in calls for image in images)
+    assert pixels < 3 * input_pixels(quiet.shape, 640)
+    assert sorted(imgsz for _, imgsz in calls) == [160, 192, 640]
+    assert all(max(image.shape[:2]) >= imgsz for images, imgsz in calls for image in images)
@@ -0,0 +1,94 @@
+import io
+import threading
+
+import pytest
+
+from s3_download import RangedDownload
+
+
+class GatedS3:
+    """Serves ranged GETs of an in-memory object, each part only once its gate is opened."""
+
+    def __init__(self, data, part_size):
+        self.data = data
+        self.gates = {start: threading.Event() for start in range(0, len(data), part_size)}
+        self.failing = set()
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = (int(n) for n in Range[len('bytes='):].split('-'))
+        self.gates[start].wait()
+        if start in self.failing:
+            raise ConnectionError(f"part at {start} failed")
+        return {'Body': io.BytesIO(self.data[start:end + 1])}
+
+    def release(self, start):
+        self.gates[start].set()
+
+    def release_all(self):
+        for gate in self.gates.values():
+            gate.set()
+
+
+@pytest.fixture
+def s3():
+    client = GatedS3(b'0123456789', part_size=4)
+    yield client
+    client.release_all()
+
+
+def start_download(s3, tmp_path):
+    return RangedDownload(s3, 'bucket', 'key', str(tmp_path / 'object'), part_size=4, workers=3)
+
+
+def wait_in_thread(download):
+    errors = []
+
+    def wait():
+        try:
+            download.wait()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    return thread, errors
+
+
+def test_wait_blocks_until_every_part_is_on_disk(s3, tmp_path):
+    download = start_download(s3, tmp_path)
+    s3.release(4)
+    s3.release(8)
+
+    thread, errors = wait_in_thread(download)
+    thread.join(0.2)
+    assert thread.is_alive()
+
+    s3.release(0)
+    thread.join(5)
+    assert not thread.is_alive() and not errors
+
+
+def test_wait_raises_a_failed_part(s3, tmp_path):
+    s3.failing.add(4)
+    download = start_download(s3, tmp_path)
+    s3.release(4)
+
+    with pytest.raises(ConnectionError):
+        download.wait()
+
+
+def test_wait_returns_the_complete_file(s3, tmp_path):
+    download = start_download(s3, tmp_path)
+    s3.release_all()
+
+    with open(download.wait(), 'rb') as f:
+        assert f.read() == b'0123456789'
+
+
+def test_an_empty_object_needs_no_parts(tmp_path):
+    download = start_download(GatedS3(b'', part_size=4), tmp_path)
+    with open(download.wait(), 'rb') as f:
+        assert f.read() == b''
@@ -0,0 +1,177 @@
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import bird_detection
+from bird_detection import SEGMENT_WARMUP_SECONDS, merge_scan_reports, merge_species_counts, plan_segments, resume_segments
+
+
+## plan_segments
+def test_one_segment_or_a_tiny_video_is_not_split():
+    assert plan_segments(SimpleNamespace(total_frames=100, fps=25), 1) == []
+    assert plan_segments(SimpleNamespace(total_frames=3, fps=25), 4) == []
+    assert plan_segments(SimpleNamespace(total_frames=None, fps=25), 4) == []
+
+
+def test_segments_cover_every_frame_once():
+    fps = 10
+    plan = plan_segments(SimpleNamespace(total_frames=101, fps=fps), 4)
+    warmup = int(fps * SEGMENT_WARMUP_SECONDS)
+
+    assert len(plan) == 4
+    assert plan[0]['count_from'] == 0
+    assert plan[-1]['end_frame'] is None
+    for segment, following in zip(plan, plan[1:]):
+        assert segment['end_frame'] == following['count_from']
+    for segment in plan:
+        assert segment['start_frame'] == max(0, segment['count_from'] - warmup)
+
+
+## merge_species_counts
+def test_merged_counts_are_the_max_per_species():
+    results = [{'magpie': 2}, {'magpie': 1, 'wren': 3}, {}, {'wren': 1, 'robin': 1}]
+    assert merge_species_counts(results) == {'magpie': 2, 'wren': 3, 'robin': 1}
+
+
+def test_merging_nothing():
+    assert merge_species_counts([]) == {}
+
+
+## merge_scan_reports
+def test_the_video_is_finished_only_if_every_segment_is():
+    finished = {'stop_reason': 'end_of_video', 'stop_frame': 40}
+    assert merge_scan_reports([finished, dict(finished, stop_frame=80)]) == {'stop_reason': 'end_of_video', 'stop_frame': 80}
+
+    converged = {'stop_reason': 'converged', 'stop_frame': 55}
+    assert merge_scan_reports([finished, converged, {'stop_reason': 'compute_budget', 'stop_frame': 90}]) == converged
+
+
+## resume_segments
+def test_segments_cut_short_continue_after_a_warm_up():
+    plan = [
+        {'start_frame': 0, 'count_from': 0, 'end_frame': 40},
+        {'start_frame': 30, 'count_from': 40, 'end_frame': 80},
+        {'start_frame': 70, 'count_from': 80, 'end_frame': None},
+    ]
+    reports = [
+        {'stop_reason': 'end_of_video', 'stop_frame': 40},
+        {'stop_reason': 'deadline', 'stop_frame': 60},
+        {'stop_reason': 'deadline', 'stop_frame': 75},  # still in its warm-up
+    ]
+    assert resume_segments(plan, reports, warmup=10) == [
+        {'start_frame': 50, 'count_from': 60, 'end_frame': 80},
+        {'start_frame': 70, 'count_from': 80, 'end_frame': None},
+    ]
+
+
+## Inline segments against a serial scan
+FPS = 24
+SIZE = (320, 240)
+
+# (BGR colour, first frame, last frame, x, y) of every square; red and blue are two species
+SQUARES = [
+    ((0, 0, 255), 0, 95, 20, 20),
+    ((255, 0, 0), 10, 40, 200, 30),
+    ((255, 0, 0), 20, 35, 260, 100),
+    ((0, 0, 255), 50, 75, 60, 150),
+    ((0, 0, 255), 60, 70, 150, 180),
+]
+
+
+def write_video(cv, path):
+    writer = cv.VideoWriter(str(path), cv.VideoWriter_fourcc(*'mp4v'), FPS, SIZE)
+    for index in range(96):
+        frame = np.full((SIZE[1], SIZE[0], 3), 255, dtype=np.uint8)
+        for color, first, last, x, y in SQUARES:
+            if first <= index <= last:
+                x += index // 4  # drift slowly so the tracker follows a moving target
+                frame[y:y + 24, x:x + 24] = color
+        writer.write(frame)
+    writer.release()
+    return str(path)
+
+
+def detect_squares(model, frames, cascade=False):
+    # Stands in for the YOLO pass: one detection per coloured square, class 0 red and 1 blue
+    cv, sv = bird_detection.cv, bird_detection.sv
+    results = []
+    for frame in frames:
+        boxes, class_ids = [], []
+        for class_id, channel in enumerate((2, 0)):
+            mask = ((frame[:, :, channel] > 128) & (frame[:, :, 1] < 128)).astype(np.uint8)
+            _, _, stats, _ = cv.connectedComponentsWithStats(mask)
+            for x, y, w, h, area in stats[1:]:
+                if area >= 100:
+                    boxes.append((x, y, x + w, y + h))
+                    class_ids.append(class_id)
+        results.append(sv.Detections(
+            xyxy=np.array(boxes, dtype=np.float32).reshape(-1, 4),
+            confidence=np.full(len(boxes), 0.9, dtype=np.float32),
+            class_id=np.array(class_ids, dtype=int),
+        ))
+    return results
+
+
+def test_inline_segments_match_a_serial_scan(tmp_path, monkeypatch):
+    cv = pytest.importorskip('cv2')
+    pytest.importorskip('supervision')
+
+    monkeypatch.setattr(bird_detection, 'load_model', lambda *args: SimpleNamespace(names={0: 'Red', 1: 'Blue'}))
+    monkeypatch.setattr(bird_detection, 'run_model', detect_squares)
+    video_path = write_video(cv, tmp_path / 'squares.mp4')
+
+    serial = json.loads(bird_detection.video_prediction(video_path, segments=1))
+    segmented = json.loads(bird_detection.video_prediction(
+        video_path, segments=3, segment_runner=bird_detection.run_segments_inline))
+
+    assert serial == {'red': 3, 'blue': 2}
+    assert segmented == serial
+
+
+def record_options(results):
+    def run(video_path, segments, options):
+        results.append(options)
+        return bird_detection.run_segments_inline(video_path, segments, options)
+    return run
+
+
+def test_segments_report_an_early_stop_and_share_the_compute_budget(tmp_path, monkeypatch):
+    cv = pytest.importorskip('cv2')
+    pytest.importorskip('supervision')
+
+    monkeypatch.setattr(bird_detection, 'load_model', lambda *args: SimpleNamespace(names={0: 'Red', 1: 'Blue'}))
+    monkeypatch.setattr(bird_detection, 'run_model', detect_squares)
+    video_path = write_video(cv, tmp_path / 'squares.mp4')
+
+    options = []
+    report = {}
+    bird_detection.video_prediction(video_path, segments=3, segment_runner=record_options(options),
+                                    report=report, batch_size=4, converge_seconds=0.5, compute_budget_seconds=30)
+
+    assert options[0]['compute_budget_seconds'] == 10
+    assert report['stop_reason'] == 'converged'
+
+
+def test_segments_stopped_by_the_deadline_resume_to_the_serial_counts(tmp_path, monkeypatch):
+    cv = pytest.importorskip('cv2')
+    pytest.importorskip('supervision')
+
+    monkeypatch.setattr(bird_detection, 'load_model', lambda *args: SimpleNamespace(names={0: 'Red', 1: 'Blue'}))
+    monkeypatch.setattr(bird_detection, 'run_model', detect_squares)
+    video_path = write_video(cv, tmp_path / 'squares.mp4')
+
+    # No time left: every segment stops after its first batch
+    with pytest.raises(bird_detection.DeadlineReached) as e:
+        bird_detection.video_prediction(video_path, segments=3, segment_runner=bird_detection.run_segments_inline,
+                                        time_left=lambda: 0, batch_size=8)
+    state = e.value.state
+    assert len(state['segments']) == 3 and state['reports'] == []
+
+    report = {}
+    resumed = json.loads(bird_detection.video_prediction(
+        video_path, segments=3, segment_runner=bird_detection.run_segments_inline,
+        resume_state=state, report=report, batch_size=8))
+    assert resumed == {'red': 3, 'blue': 2}
+    assert report['stop_reason'] == 'end_of_video'
@@ -0,0 +1,54 @@
+import os
+
+from workspace import Workspace
+
+
+def make_file(path, size, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(path, (mtime, mtime))
+
+
+def test_evicts_least_recently_modified_until_under_the_cap(tmp_path):
+    make_file(tmp_path / 'model.pt', 100, 0)
+    make_file(tmp_path / 'old.bin', 100, 1000)
+    make_file(tmp_path / 'middle.bin', 100, 2000)
+    make_file(tmp_path / 'new.bin', 100, 3000)
+
+    space = Workspace(root=str(tmp_path), max_bytes=250, pinned={'model.pt', 'jobs'})
+    assert space.evict() == 200
+
+    assert sorted(os.listdir(tmp_path)) == ['model.pt', 'new.bin']
+    assert space.evicted_bytes == 200
+
+
+def test_makes_room_for_the_bytes_a_job_needs(tmp_path):
+    make_file(tmp_path / 'old.bin', 100, 1000)
+    make_file(tmp_path / 'new.bin', 100, 2000)
+
+    space = Workspace(root=str(tmp_path), max_bytes=300, pinned={'jobs'})
+    space.evict()
+    assert sorted(os.listdir(tmp_path)) == ['new.bin', 'old.bin']
+
+    space.evict(needed_bytes=150)
+    assert os.listdir(tmp_path) == ['new.bin']
+
+
+def test_active_jobs_and_pinned_entries_are_never_evicted(tmp_path):
+    make_file(tmp_path / 'numba_cache' / 'kernel.nbc', 100, 0)
+    make_file(tmp_path / 'jobs' / 'crashed' / 'frame.jpg', 100, 0)
+    os.utime(tmp_path / 'jobs' / 'crashed', (0, 0))
+
+    space = Workspace(root=str(tmp_path), max_bytes=0, pinned={'numba_cache', 'jobs'})
+    job_dir = space.allocate('running')
+    make_file(os.path.join(job_dir, 'video.mp4'), 100, 0)
+    os.utime(job_dir, (0, 0))
+
+    space.evict()
+    assert os.path.exists(tmp_path / 'numba_cache' / 'kernel.nbc')
+    assert os.path.exists(os.path.join(job_dir, 'video.mp4'))
+    assert not os.path.exists(tmp_path / 'jobs' / 'crashed')
+
+    space.release(job_dir)
+    assert not os.path.exists(job_dir)
@@ -1,20 +1,220 @@
 import os
+import io
 import json
 import boto3
-import subprocess
-import pandas as pd
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from s3_download import download
+from workspace import workspace
+from cpu_threads import configure_threads
+from birdnet_engine import BirdNETEngine, WindowScores
+from content_cache import sha256_file, lookup, store, move_to_shared, DEDUP_SHARED_OBJECTS
 
 s3_client = boto3.client('s3')
 dynamodb = boto3.client('dynamodb')
+# Chunk invokes are synchronous and can run up to the 15 minute Lambda limit; a retried
+# invoke would run the chunk twice, so no retries and a read timeout past that limit
+lambda_client = boto3.client('lambda', config=Config(read_timeout=900, connect_timeout=10, retries={'max_attempts': 0}))
+
+# Long recordings (AUDIO_CHUNK_SECONDS > 0) are analysed chunk-parallel in local worker
+# processes ('process') or as one invocation of CHUNK_WORKER_FUNCTION per chunk ('lambda')
+AUDIO_CHUNK_RUNNER = os.environ.get('AUDIO_CHUNK_RUNNER', 'process')
+CHUNK_WORKER_FUNCTION = os.environ.get('CHUNK_WORKER_FUNCTION', os.environ.get('AWS_LAMBDA_FUNCTION_NAME', ''))
+CHUNK_PREFIX = 'audio_chunks/'  # chunk results pass through S3, they can be over the invoke payload limit
+
+# Records of one event are downloaded and written this many at a time
+RECORD_WORKERS = int(os.environ.get('RECORD_WORKERS', '8'))
+
+# Per-window BirdNET scores are kept next to the user's files so tags can be recomputed
+# for another sensitivity, threshold or species list without re-running the model
+SAVE_WINDOW_SCORES = os.environ.get('SAVE_WINDOW_SCORES', 'true').lower() == 'true'
+
+# BirdNET gets one thread per vCPU the function's memory setting provides
+BIRDNET_THREADS = configure_threads()['threads']
+
+# Loaded once per container, during the Lambda init phase unless WARM_START is off
+engine = BirdNETEngine(threads=BIRDNET_THREADS)
+if os.environ.get('WARM_START', 'true').lower() == 'true':
+    try:
+        engine.load()
+    except Exception as e:
+        print(f"Warm start failed, the model will load on first use: {e}")
+
+def lambda_chunk_runner(bucket_name, object_key, job_id):
+    def run(audio_path, chunks):
+        def invoke(indexed_chunk):
+            i, chunk = indexed_chunk
+            result_key = f"{CHUNK_PREFIX}{job_id}/{i}.npz"
+            response = lambda_client.invoke(
+                FunctionName=CHUNK_WORKER_FUNCTION,
+                Payload=json.dumps({'chunk_job': {
+                    'bucket': bucket_name,
+                    'key': object_key,
+                    'chunk': chunk,
+                    'result_key': result_key,
+                }})
+            )
+            payload = json.loads(response['Payload'].read())
+            if response.get('FunctionError') or payload.get('statusCode') != 200:
+                raise Exception(f"Chunk worker failed: {payload}")
+
+            body = s3_client.get_object(Bucket=bucket_name, Key=result_key)['Body'].read()
+            s3_client.delete_object(Bucket=bucket_name, Key=result_key)
+            return WindowScores.load(io.BytesIO(body))
+
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            return list(executor.map(invoke, enumerate(chunks)))
+
+    return run
+
+def handle_chunk_job(job, job_dir):
+    # Worker side of the 'lambda' chunk runner: one time range of a recording already in S3
+    audio_path = download(s3_client, job['bucket'], job['key'], os.path.join(job_dir, os.path.basename(job['key'])))
+    buffer = io.BytesIO()
+    engine.analyze(audio_path, **job['chunk']).save(buffer)
+    s3_client.put_object(Bucket=job['bucket'], Key=job['result_key'], Body=buffer.getvalue())
+    return {'statusCode': 200, 'result_key': job['result_key']}
+
+def scores_key(user_id, item_id):
+    # Format: users/{user_id}/scores/{item_id}.npz (outside raw/ so it doesn't trigger detection)
+    return f"users/{user_id}/scores/{item_id}.npz"
+
+def save_scores(job):
+    # The scores of this recording, or of the earlier upload with the same content
+    key = scores_key(job['user_id'], job['item_id'])
+    if job.get('scores') is not None:
+        s3_client.put_object(Bucket=job['bucket'], Key=key, Body=job['scores'])
+    elif job.get('cached_scores_key') and job['cached_scores_key'] != key:
+        try:
+            s3_client.copy_object(
+                CopySource={'Bucket': job['bucket'], 'Key': job['cached_scores_key']},
+                Bucket=job['bucket'],
+                Key=key
+            )
+        except s3_client.exceptions.ClientError as e:
+            print(f"Couldn't copy the scores of the earlier upload: {e}")
+
+def set_original_url(item_id, bucket_name, object_key):
+    dynamodb.update_item(
+        TableName='birdtag_location',
+        Key={'id': {'S': item_id}},
+        UpdateExpression="SET original_url = :url",
+        ExpressionAttributeValues={':url': {'S': f'https://{bucket_name}.s3.ap-southeast-2.amazonaws.com/{object_key}'}}
+    )
+
+def prepare_record(job):
+    # Download audio file to the job directory with parallel ranged GETs, then look its content up
+    download(s3_client, job['bucket'], job['key'], job['path'])
+    job['digest'] = sha256_file(job['path'])
+    try:
+        cached = lookup(job['digest'], require_artifacts=SAVE_WINDOW_SCORES)
+    except Exception as e:
+        # The cache only saves a model run, it never fails a record
+        print(f"Content cache lookup failed for {job['key']}, analysing it: {e}")
+        cached = None
+    job['species_counts'] = cached['tags'] if cached else None
+    job['cached_scores_key'] = cached['detections_key'] if cached else None
+    return job
+
+def finish_record(job):
+    if SAVE_WINDOW_SCORES:
+        save_scores(job)
+
+    if job.get('remember'):
+        try:
+            store(job['digest'], 'audio', job['species_counts'],
+                  scores_key(job['user_id'], job['item_id']) if SAVE_WINDOW_SCORES else None)
+        except Exception as e:
+            print(f"Could not cache the tags of {job['key']}: {e}")
+
+    if DEDUP_SHARED_OBJECTS:
+        move_to_shared(s3_client, job['digest'], job['bucket'], job['key'],
+                       lambda shared_key: set_original_url(job['item_id'], job['bucket'], shared_key))
+
+    species_counts = job['species_counts']
+    if not species_counts:
+        print(f"No birds detected in {job['filename']}")
+        return
+
+    print(f"Species detected in {job['filename']}:", species_counts)
+
+    dynamodb.update_item(
+        TableName='birdtag_location',
+        Key={'id': {'S': job['item_id']}},
+        UpdateExpression="SET file_type = :ftype, tags = :tags",
+        ExpressionAttributeValues={
+            ':ftype': {'S': 'audio'},
+            ':tags': {'M': {k: {'N': str(v)} for k, v in species_counts.items()}}
+        }
+    )
+
+def run_isolated(step, jobs, failed):
+    # Runs step on the jobs concurrently and returns those that succeeded;
+    # a failing job is recorded in failed instead of failing the others
+    def attempt(job):
+        try:
+            step(job)
+            return True
+        except Exception as e:
+            print(f"Error processing {job['key']}: {e!r}")
+            failed[job['key']] = repr(e)
+            return False
+
+    with ThreadPoolExecutor(max_workers=RECORD_WORKERS) as executor:
+        succeeded = list(executor.map(attempt, jobs))
+    return [job for job, ok in zip(jobs, succeeded) if ok]
+
+def analyze_records(jobs, failed):
+    # One BirdNET run over every recording not found in the content cache;
+    # uploads with the same content in this event are analysed once
+    pending = {}
+    for job in jobs:
+        if job['species_counts'] is None:
+            pending.setdefault(job['digest'], job)
+
+    chunk_runners = {}
+    if AUDIO_CHUNK_RUNNER == 'lambda':
+        chunk_runners = {job['path']: lambda_chunk_runner(job['bucket'], job['key'], job['item_id'])
+                         for job in pending.values()}
+    results = engine.analyze_batch([job['path'] for job in pending.values()], chunk_runners) if pending else {}
+
+    analysed = {}
+    for digest, job in pending.items():
+        result = results[job['path']]
+        if isinstance(result, Exception):
+            print(f"Error processing {job['key']}: {result!r}")
+            continue
+        buffer = io.BytesIO()
+        result.save(buffer)
+        analysed[digest] = (result.species_counts(), buffer.getvalue())
+        job['remember'] = True  # one upload per content goes into the content cache
+
+    ready = []
+    for job in jobs:
+        if job['species_counts'] is None and job['digest'] not in analysed:
+            failed[job['key']] = repr(results[pending[job['digest']]['path']])
+            continue
+        if job['species_counts'] is None:
+            job['species_counts'], job['scores'] = analysed[job['digest']]
+        else:
+            print(f"{job['filename']} has the same content as an earlier upload, reusing its tags")
+        ready.append(job)
+    return ready
 
 def lambda_handler(event, context):
+    # Scratch space for this invocation, removed when it ends
+    job_dir = workspace.allocate(context.aws_request_id if context else None)
+
     try:
+        if 'chunk_job' in event:
+            return handle_chunk_job(event['chunk_job'], job_dir)
+
+        jobs = []
         for record in event['Records']:
             bucket_name = record['s3']['bucket']['name']
             object_key = record['s3']['object']['key']
             parts = object_key.split('/')
             filename = parts[3]
-            tmp_audio_path = f"/tmp/{filename}"
             item_id, ext = os.path.splitext(filename)
             ext = ext.lower()
 
@@ -22,60 +222,26 @@ def lambda_handler(event, context):
                 print(f"Unsupported file type: {ext}")
                 continue
 
-            # Download audio file to /tmp/
-            s3_client.download_file(bucket_name, object_key, tmp_audio_path)
-
-            env = os.environ.copy()
-            env["NUMBA_CACHE_DIR"] = "/tmp/numba_cache"
-            env["NUMBA_DISABLE_CACHE"] = "1"
-            env["TMPDIR"] = "/tmp"
-            env["TEMP"] = "/tmp"
-            
-            # Run BirdNET CLI
-            output_dir = "/tmp"
-            os.chdir('/opt/BirdNET-Analyzer')
-            command = [
-                "python3", "-m", "birdnet_analyzer.analyze",
-                tmp_audio_path,
-                "--output", output_dir,
-                "--rtype", "table",
-                "--sensitivity", "0.5",
-                "--threads", "1"
-            ]
-
-            try:
-                subprocess.run(command, check=True, env=env)
-            except subprocess.CalledProcessError as e:
-                print("BirdNET Analyzer failed:", e)
-                return {"statusCode": 500, "body": "Detection failed"}
-            
-            base_name = os.path.splitext(filename)[0]
-            result_file_path = os.path.join(output_dir, f"{base_name}.BirdNET.selection.table.txt")
-            if not os.path.exists(result_file_path):
-                print(f"No result file generated for {filename}")
-                continue
-
-            df = pd.read_csv(result_file_path, sep="\t")
+            jobs.append({
+                'bucket': bucket_name,
+                'key': object_key,
+                'user_id': parts[1],
+                'filename': filename,
+                'item_id': item_id,
+                'path': os.path.join(job_dir, filename),
+            })
 
-            if df.empty:
-                print(f"No birds detected in {filename}")
-                continue
-
-            species_list = df['Common Name'].unique().tolist()
-            species_counts = {species: 1 for species in species_list}
-
-            print(f"Species detected in {filename}:", species_counts)
-
-            dynamodb.update_item(
-                TableName='birdtag_location',
-                Key={'id': {'S': item_id}},
-                UpdateExpression="SET file_type = :ftype, tags = :tags",
-                ExpressionAttributeValues={
-                    ':ftype': {'S': 'audio'},
-                    ':tags': {'M': {k: {'N': str(v)} for k, v in species_counts.items()}}
-                }
-            )
+        # Each record is downloaded, analysed and written independently of the others failing
+        failed = {}
+        jobs = run_isolated(prepare_record, jobs, failed)
+        jobs = analyze_records(jobs, failed)
+        jobs = run_isolated(finish_record, jobs, failed)
 
+        if failed:
+            return {
+                "statusCode": 207,
+                "body": json.dumps({'processed': [job['key'] for job in jobs], 'failed': failed})
+            }
 
         return {
             "statusCode": 200,
@@ -88,3 +254,5 @@ def lambda_handler(event, context):
             "statusCode": 500,
             "body": json.dumps(f"Error: {str(e)}")
         }
+    finally:
+        workspace.release(job_dir)
\ No newline at end of file
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Recomputes the tags of every processed recording from its saved BirdNET
+# window scores (users/{user_id}/scores/{item_id}.npz) for a new sensitivity,
+# confidence threshold or species list, without running the model again.
+#
+# Usage: python rescore_from_scores.py --min-confidence 0.3 [--sensitivity 1.0]
+#            [--species-list species_list.txt] [--dry-run]
+#
+# A species list has one species per line, as a BirdNET label
+# ("Scientific name_Common name"), a scientific or a common name.
+
+import argparse
+import io
+import os
+
+import boto3
+
+from birdnet_engine import MIN_CONFIDENCE, SENSITIVITY, rescore
+
+bucket_name = 'birdtag-cloud170'
+table_name = 'birdtag_location'
+s3_client = boto3.client('s3')
+dynamodb = boto3.client('dynamodb')
+
+
+def score_files():
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix='users/'):
+        for obj in page.get('Contents', []):
+            parts = obj['Key'].split('/')
+            if len(parts) == 4 and parts[2] == 'scores' and parts[3].endswith('.npz'):
+                yield obj['Key']
+
+
+def read_species_list(path):
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip() and not line.startswith('#')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute audio tags from saved BirdNET window scores")
+    parser.add_argument('--min-confidence', type=float, default=MIN_CONFIDENCE)
+    parser.add_argument('--sensitivity', type=float, default=SENSITIVITY)
+    parser.add_argument('--species-list', default=None, help="only tag the species in this file")
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    species = read_species_list(args.species_list) if args.species_list else None
+
+    for key in score_files():
+        item_id = os.path.splitext(key.split('/')[3])[0]
+        body = s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+        species_counts = rescore(io.BytesIO(body), min_confidence=args.min_confidence,
+                                 sensitivity=args.sensitivity, species=species)
+        print(f"{item_id}: {species_counts}")
+
+        if args.dry_run:
+            continue
+
+        dynamodb.update_item(
+            TableName=table_name,
+            Key={'id': {'S': item_id}},
+            UpdateExpression="SET tags = :tags",
+            ExpressionAttributeValues={
+                ':tags': {'M': {k: {'N': str(v)} for k, v in species_counts.items()}}
+            }
+        )
+
+
+if __name__ == '__main__':
+    main()
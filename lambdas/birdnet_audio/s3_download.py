@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Parallel ranged S3 downloads, shared by the detection and BirdNET Lambdas.
+# Keep the copies in every Lambda folder identical.
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+
+PART_SIZE = int(os.environ.get('S3_DOWNLOAD_PART_MB', '8')) * 1024 * 1024
+MAX_WORKERS = int(os.environ.get('S3_DOWNLOAD_WORKERS', '16'))
+
+# For boto3 managed transfers (download_file/upload_file), tuned the same way
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=PART_SIZE,
+    multipart_chunksize=PART_SIZE,
+    max_concurrency=MAX_WORKERS,
+)
+
+
+class RangedDownload:
+    """
+    Downloads an S3 object with parallel ranged GETs into a preallocated file.
+    wait() blocks until all of it has arrived.
+    """
+
+    def __init__(self, s3_client, bucket_name, object_key, path, part_size=PART_SIZE, workers=MAX_WORKERS):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.object_key = object_key
+        self.path = path
+        self.part_size = part_size
+        self.size = s3_client.head_object(Bucket=bucket_name, Key=object_key)['ContentLength']
+        self.done = set()
+        self.error = None
+        self.condition = threading.Condition()
+
+        # Preallocate the file so every part can be written in place
+        with open(path, 'wb') as f:
+            f.truncate(self.size)
+
+        starts = list(range(0, self.size, part_size))
+        self.parts = len(starts)
+
+        self.executor = ThreadPoolExecutor(max_workers=max(1, min(workers, self.parts)))
+        for start in starts:
+            self.executor.submit(self.fetch, start)
+        self.executor.shutdown(wait=False)
+
+    def fetch(self, start):
+        end = min(start + self.part_size, self.size) - 1
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.object_key, Range=f"bytes={start}-{end}")
+            data = response['Body'].read()
+            with open(self.path, 'r+b') as f:
+                f.seek(start)
+                f.write(data)
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+            return
+
+        with self.condition:
+            self.done.add(start)
+            self.condition.notify_all()
+
+    def wait(self):
+        # Block until every part is on disk, or raise the first part that failed
+        with self.condition:
+            while len(self.done) < self.parts:
+                if self.error is not None:
+                    raise self.error
+                self.condition.wait()
+        return self.path
+
+
+def download(s3_client, bucket_name, object_key, path):
+    # Parallel ranged download of the whole object, returns the local path
+    return RangedDownload(s3_client, bucket_name, object_key, path).wait()
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from birdnet_engine import LOGIT_CLIP, BirdNETEngine, active_windows
+
+RATE = 48000
+
+
+def window(rng, tone_hz=None):
+    # 3 s of faint background noise, with a half-second tone in the middle when tone_hz is set
+    sig = rng.normal(0, 0.01, 3 * RATE)
+    if tone_hz:
+        t = np.arange(RATE // 2) / RATE
+        sig[RATE:RATE + RATE // 2] += 0.2 * np.sin(2 * np.pi * tone_hz * t)
+    return sig.astype(np.float32)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+def test_calls_stand_out_from_the_background(rng):
+    windows = [window(rng) for _ in range(8)] + [window(rng, tone_hz=4000)]
+    assert active_windows(windows, RATE).tolist() == [False] * 8 + [True]
+
+
+def test_sound_below_the_bird_band_is_not_activity(rng):
+    windows = [window(rng) for _ in range(8)] + [window(rng, tone_hz=200)]
+    assert not active_windows(windows, RATE).any()
+
+
+def test_no_windows():
+    assert active_windows([], RATE).size == 0
+
+
+def test_inactive_windows_skip_the_model_and_get_the_lowest_logit():
+    batches = []
+
+    class Model:
+        def predict(self, batch):
+            batches.append(len(batch))
+            return np.ones((len(batch), 2))
+
+    engine = BirdNETEngine(batch_size=2)
+    engine.model, engine.labels = Model(), ['Corvus coronoides_Australian Raven', 'Malurus cyaneus_Superb Fairywren']
+    windows = [np.zeros(3 * RATE, dtype=np.float32)] * 4
+    first, second = engine.score_blocks([(windows[:3], np.array([True, False, True])),
+                                         (windows[3:], np.array([True]))])
+
+    assert batches == [2, 1]  # three active windows, batches filled across the blocks
+    np.testing.assert_array_equal(first[1], -LOGIT_CLIP)
+    np.testing.assert_array_equal(first[[0, 2]], 1)
+    np.testing.assert_array_equal(second, 1)
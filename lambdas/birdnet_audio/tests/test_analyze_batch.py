@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from birdnet_engine import BirdNETEngine, WindowScores
+
+RATE = 100  # samples per second, the fakes below don't care about the real 48 kHz
+LABELS = ['Corvus coronoides_Australian Raven', 'Malurus cyaneus_Superb Fairywren']
+
+
+class FakeAudio:
+    """Stands in for birdnet_analyzer.audio over in-memory recordings; a recording of None fails to decode."""
+
+    def __init__(self, recordings):
+        self.recordings = recordings
+
+    def get_audio_file_length(self, path):
+        sig = self.recordings[path]
+        return 0.0 if sig is None else sig.size / RATE
+
+    def open_audio_file(self, path, rate, offset, duration, fmin, fmax):
+        if self.recordings[path] is None:
+            raise ValueError(f"can't decode {path}")
+        return self.recordings[path], rate
+
+    def split_signal(self, sig, rate, seconds, overlap, minlen):
+        step = int(seconds * rate)
+        return [sig[i:i + step] for i in range(0, sig.size, step)]
+
+
+class FakeModel:
+    """Scores a window by its first sample: 1 is a raven, 2 a fairywren."""
+
+    def __init__(self):
+        self.batches = []
+
+    def predict(self, batch):
+        self.batches.append(len(batch))
+        logits = np.full((len(batch), len(LABELS)), -10.0)
+        for i, window in enumerate(batch):
+            if window[0]:
+                logits[i, int(window[0]) - 1] = 10.0
+        return logits
+
+
+def recording(*calls):
+    # 3 s windows, each starting with its call (0 for none)
+    sig = np.zeros(3 * RATE * len(calls), dtype=np.float32)
+    sig[::3 * RATE] = calls
+    return sig
+
+
+@pytest.fixture
+def engine():
+    engine = BirdNETEngine(batch_size=4)
+    engine.cfg = SimpleNamespace(SAMPLE_RATE=RATE, SIG_LENGTH=3.0, SIG_OVERLAP=0.0, SIG_MINLEN=1.0)
+    engine.model, engine.labels = FakeModel(), LABELS
+    return engine
+
+
+def test_recordings_share_the_model_batches(engine):
+    engine.audio = FakeAudio({'a.wav': recording(1, 0, 1), 'b.wav': recording(2, 2)})
+    results = engine.analyze_batch(['a.wav', 'b.wav'])
+
+    assert engine.model.batches == [4, 1]
+    assert results['a.wav'].species_counts() == {'Australian Raven': 1}
+    assert results['b.wav'].species_counts() == {'Superb Fairywren': 1}
+    assert results['a.wav'].starts.tolist() == [0.0, 3.0, 6.0]
+
+
+def test_a_recording_that_fails_to_decode_fails_alone(engine):
+    engine.audio = FakeAudio({'a.wav': recording(1), 'bad.wav': None, 'b.wav': recording(2)})
+    results = engine.analyze_batch(['a.wav', 'bad.wav', 'b.wav'])
+
+    assert list(results) == ['a.wav', 'bad.wav', 'b.wav']
+    assert isinstance(results['bad.wav'], ValueError)
+    assert isinstance(results['a.wav'], WindowScores) and isinstance(results['b.wav'], WindowScores)
+    assert results['b.wav'].species_counts() == {'Superb Fairywren': 1}
+
+
+def test_a_failed_model_pass_fails_the_pooled_recordings(engine):
+    engine.audio = FakeAudio({'a.wav': recording(1), 'b.wav': recording(2)})
+
+    def predict(batch):
+        raise RuntimeError("interpreter failed")
+
+    engine.model.predict = predict
+    results = engine.analyze_batch(['a.wav', 'b.wav'])
+    assert all(isinstance(result, RuntimeError) for result in results.values())
+
+
+def test_the_pool_is_scored_before_it_passes_the_window_cap(engine):
+    engine.audio = FakeAudio({'a.wav': recording(1, 0), 'b.wav': recording(2, 0), 'c.wav': recording(1)})
+    results = engine.analyze_batch(['a.wav', 'b.wav', 'c.wav'], max_pooled_windows=3)
+
+    assert engine.model.batches == [2, 3]
+    assert [results[path].species_counts() for path in ('a.wav', 'b.wav', 'c.wav')] == [
+        {'Australian Raven': 1}, {'Superb Fairywren': 1}, {'Australian Raven': 1}]
+
+
+def test_a_recording_over_the_cap_is_scored_on_its_own(engine):
+    engine.audio = FakeAudio({'a.wav': recording(1, 0, 0, 0, 0), 'b.wav': recording(2)})
+    engine.analyze_batch(['a.wav', 'b.wav'], max_pooled_windows=3)
+    assert engine.model.batches == [4, 1, 1]
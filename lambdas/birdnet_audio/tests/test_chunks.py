@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from birdnet_engine import plan_chunks
+
+
+def grid_windows(start, end, length, sig_length, overlap):
+    # Window starts a run over [start, end) analyses: whole windows, except the partial one at the end of the recording
+    step = sig_length - overlap
+    starts = []
+    position = start
+    while position < length and not np.isclose(position, length):
+        if end is not None and position + sig_length > end + 1e-9:
+            break
+        starts.append(round(position, 6))
+        position += step
+    return starts
+
+
+def test_short_recordings_and_no_chunking_give_no_plan():
+    assert plan_chunks(100.0, 0, 3.0) == []
+    assert plan_chunks(100.0, 100.0, 3.0) == []
+    assert plan_chunks(20.0, 30.0, 3.0) == []
+
+
+def test_chunks_without_overlap():
+    assert plan_chunks(100.0, 30.0, 3.0) == [
+        {'start': 0.0, 'end': 30.0},
+        {'start': 30.0, 'end': 60.0},
+        {'start': 60.0, 'end': 90.0},
+        {'start': 90.0, 'end': None},
+    ]
+
+
+def test_chunk_shorter_than_a_window_still_covers_one():
+    assert plan_chunks(10.0, 1.0, 3.0)[0] == {'start': 0.0, 'end': 3.0}
+
+
+@pytest.mark.parametrize('length, chunk_seconds, overlap', [
+    (100.0, 30.0, 0.0),
+    (100.0, 30.0, 1.0),
+    (61.7, 10.0, 1.5),
+    (600.0, 45.0, 2.0),
+])
+def test_chunks_analyse_exactly_the_windows_of_a_full_run(length, chunk_seconds, overlap):
+    sig_length = 3.0
+    step = sig_length - overlap
+    plan = plan_chunks(length, chunk_seconds, sig_length, overlap)
+
+    assert plan[0]['start'] == 0.0
+    assert plan[-1]['end'] is None
+    for chunk, following in zip(plan, plan[1:]):
+        assert np.isclose(chunk['end'], following['start'] + overlap)
+    for chunk in plan:
+        assert np.isclose(chunk['start'] / step, round(chunk['start'] / step))
+
+    chunked = [w for chunk in plan for w in grid_windows(chunk['start'], chunk['end'], length, sig_length, overlap)]
+    assert chunked == grid_windows(0.0, None, length, sig_length, overlap)
@@ -0,0 +1,85 @@
+import io
+
+import numpy as np
+import pytest
+
+from birdnet_engine import LOGIT_CLIP, MAX_SENSITIVITY, MIN_STORED_CONFIDENCE, STORED_LOGIT_FLOOR, WindowScores, rescore
+
+LABELS = [
+    'Gymnorhina tibicen_Australian Magpie',
+    'Malurus cyaneus_Superb Fairywren',
+    'Corvus coronoides_Australian Raven',
+    'Rhipidura leucophrys_Willie-wagtail',
+    'Dacelo novaeguineae_Laughing Kookaburra',
+    'Cacatua galerita_Sulphur-crested Cockatoo',
+]
+
+# (min_confidence, sensitivity) pairs the saved scores must tag exactly
+SETTINGS = [(c, s) for c in (MIN_STORED_CONFIDENCE, 0.1, 0.25, 0.5, 0.9) for s in (0.5, 1.0, 1.25, MAX_SENSITIVITY)]
+
+
+@pytest.fixture
+def scores():
+    # Mostly low logits with a spread of calls, like a real recording
+    rng = np.random.default_rng(0)
+    windows = 200
+    starts = np.arange(windows) * 3.0
+    logits = rng.normal(-12, 5, (windows, len(LABELS)))
+    skipped = rng.random(windows) < 0.2
+    logits[skipped] = -LOGIT_CLIP
+    return WindowScores(starts, starts + 3.0, logits, LABELS, skipped)
+
+
+def saved(scores):
+    f = io.BytesIO()
+    scores.save(f)
+    f.seek(0)
+    return f
+
+
+def test_load_restores_the_recording_and_the_stored_logits(scores):
+    loaded = WindowScores.load(saved(scores))
+
+    np.testing.assert_array_equal(loaded.starts, scores.starts)
+    np.testing.assert_array_equal(loaded.ends, scores.ends)
+    np.testing.assert_array_equal(loaded.skipped, scores.skipped)
+    assert loaded.labels == LABELS
+    assert loaded.sensitivity == scores.sensitivity
+
+    kept = scores.logits >= STORED_LOGIT_FLOOR
+    assert 0 < kept.sum() < kept.size
+    np.testing.assert_array_equal(loaded.logits[kept], scores.logits[kept])
+    assert (loaded.logits[~kept] == -LOGIT_CLIP).all()
+
+
+@pytest.mark.parametrize('min_confidence, sensitivity', SETTINGS)
+def test_loaded_scores_tag_like_the_dense_scores(scores, min_confidence, sensitivity):
+    loaded = WindowScores.load(saved(scores))
+    assert loaded.species_counts(min_confidence, sensitivity) == scores.species_counts(min_confidence, sensitivity)
+
+
+@pytest.mark.parametrize('min_confidence, sensitivity', SETTINGS)
+def test_rescore_matches_the_dense_species_counts(scores, min_confidence, sensitivity):
+    assert rescore(saved(scores), min_confidence, sensitivity) == scores.species_counts(min_confidence, sensitivity)
+
+
+def test_the_settings_give_different_tags(scores):
+    # Otherwise the comparisons above would prove little
+    tags = {tuple(sorted(scores.species_counts(c, s))) for c, s in SETTINGS}
+    assert len(tags) > 2
+
+
+def test_species_list_takes_labels_scientific_and_common_names(scores):
+    species = {LABELS[0], 'Malurus cyaneus', 'Australian Raven'}
+    expected = {name: 1 for name in ('Australian Magpie', 'Superb Fairywren', 'Australian Raven')
+                if name in scores.species_counts(MIN_STORED_CONFIDENCE, MAX_SENSITIVITY)}
+
+    assert scores.species_counts(MIN_STORED_CONFIDENCE, MAX_SENSITIVITY, species) == expected
+    assert rescore(saved(scores), MIN_STORED_CONFIDENCE, MAX_SENSITIVITY, species) == expected
+
+
+def test_rescore_refuses_settings_the_stored_scores_cannot_answer(scores):
+    with pytest.raises(ValueError):
+        rescore(saved(scores), min_confidence=MIN_STORED_CONFIDENCE / 2)
+    with pytest.raises(ValueError):
+        rescore(saved(scores), sensitivity=MAX_SENSITIVITY + 0.1)
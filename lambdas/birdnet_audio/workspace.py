@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Bounded /tmp workspace for the Lambdas: per-job scratch directories, a cap on
+# total bytes with LRU eviction, pinned model caches and a disk usage metric.
+# Keep the copies in every Lambda folder identical.
+
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+TMP_ROOT = '/tmp'
+JOBS_DIR = 'jobs'
+TMP_MAX_MB = int(os.environ.get('TMP_WORKSPACE_MAX_MB', '450'))
+
+# Model files and compiler caches survive eviction
+PINNED = {
+    'model.pt',
+    'model.onnx',
+    'model.int8.onnx',
+    'model_manifest.json',
+    'numba_cache',
+    JOBS_DIR,
+}
+
+METRIC_NAMESPACE = 'BirdTag'
+
+
+def entry_size(path):
+    if os.path.isfile(path) or os.path.islink(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass  # removed while walking
+    return total
+
+
+def remove_entry(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Workspace:
+    """
+    Hands out one scratch directory per job under /tmp/jobs and removes it
+    when the job ends, whether it succeeded or not. Before a job starts,
+    least recently modified entries in /tmp (left by crashed jobs or older
+    code) are evicted until usage is under the cap; pinned model caches and
+    active jobs are never evicted.
+    """
+
+    def __init__(self, root=TMP_ROOT, max_bytes=TMP_MAX_MB * 1024 * 1024, pinned=PINNED):
+        self.root = root
+        self.jobs_root = os.path.join(root, JOBS_DIR)
+        self.max_bytes = max_bytes
+        self.pinned = pinned
+        self.active = set()
+        self.evicted_bytes = 0
+
+    def entries(self):
+        # Top-level /tmp entries plus finished job directories, with size and last modification
+        paths = [os.path.join(self.root, name) for name in os.listdir(self.root) if name not in self.pinned]
+        if os.path.isdir(self.jobs_root):
+            paths += [os.path.join(self.jobs_root, name) for name in os.listdir(self.jobs_root)
+                      if os.path.join(self.jobs_root, name) not in self.active]
+
+        entries = []
+        for path in paths:
+            try:
+                entries.append((os.path.getmtime(path), entry_size(path), path))
+            except OSError:
+                pass
+        return entries
+
+    def usage(self):
+        return entry_size(self.root)
+
+    def evict(self, needed_bytes=0):
+        used = self.usage()
+        for _, size, path in sorted(self.entries()):
+            if used + needed_bytes <= self.max_bytes:
+                break
+            print(f"Evicting {path} ({size} bytes) from {self.root}")
+            remove_entry(path)
+            used -= size
+            self.evicted_bytes += size
+        return used
+
+    def allocate(self, job_id=None, needed_bytes=0):
+        self.evict(needed_bytes)
+        job_dir = os.path.join(self.jobs_root, job_id or str(uuid.uuid4()))
+        os.makedirs(job_dir, exist_ok=True)
+        self.active.add(job_dir)
+        return job_dir
+
+    def release(self, job_dir):
+        self.active.discard(job_dir)
+        remove_entry(job_dir)
+        self.report_usage()
+
+    @contextmanager
+    def job(self, job_id=None, needed_bytes=0):
+        job_dir = self.allocate(job_id, needed_bytes)
+        try:
+            yield job_dir
+        finally:
+            self.release(job_dir)
+
+    def report_usage(self):
+        # CloudWatch Embedded Metric Format, picked up from the function's logs
+        used = self.usage()
+        function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRIC_NAMESPACE,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [
+                        {'Name': 'TmpUsedBytes', 'Unit': 'Bytes'},
+                        {'Name': 'TmpEvictedBytes', 'Unit': 'Bytes'},
+                    ],
+                }],
+            },
+            'FunctionName': function_name,
+            'TmpUsedBytes': used,
+            'TmpEvictedBytes': self.evicted_bytes,
+        }))
+        return used
+
+
+workspace = Workspace()
@@ -2,6 +2,7 @@ import json
 import boto3
 from boto3.dynamodb.conditions import Key
 from urllib.parse import urlparse
+from content_cache import release_object, SHARED_PREFIX
 
 
 s3 = boto3.client('s3')
@@ -89,7 +90,12 @@ def lambda_handler(event, context):
             # 5.1 delete original file
             try:                
                 bucket_org, key_org = extract_bucket_and_key(original_url)
-                s3.delete_object(Bucket=bucket_org, Key=key_org)
+                # Uploads with identical bytes can share one copy under content/ (DEDUP_SHARED_OBJECTS
+                # in the detection Lambdas), which goes with its last reference
+                if key_org.startswith(SHARED_PREFIX):
+                    release_object(s3, bucket_org, key_org)
+                else:
+                    s3.delete_object(Bucket=bucket_org, Key=key_org)
                 print(f'bucket: {bucket_org}, key: {key_org}')
                 print(f'deleted from S3 original: {original_url}')
                 original_deleted = True
@@ -108,8 +114,21 @@ def lambda_handler(event, context):
                     thumbnail_deleted = False
 
 
-            # 5.3 delete item from dynamodb if all s3 deletes succeeded
-            if original_deleted and thumbnail_deleted:
+            # 5.3 delete the raw detections (image/video) and BirdNET window scores (audio) saved for
+            # re-tagging: users/{user_id}/detections/{item_id}.npz and users/{user_id}/scores/{item_id}.npz
+            # (S3 deletes of a missing key succeed, so files without them pass too)
+            artifacts_deleted = original_deleted
+            if original_deleted:
+                for folder in ('detections', 'scores'):
+                    try:
+                        s3.delete_object(Bucket=bucket_org, Key=f"users/{user_id}/{folder}/{item_id}.npz")
+                        print(f'deleted from S3 {folder}: {item_id}')
+                    except Exception as s3err:
+                        print(f"[WARN] Failed to delete the {folder} of {item_id}: {s3err}")
+                        artifacts_deleted = False
+
+            # 5.4 delete item from dynamodb if all s3 deletes succeeded
+            if original_deleted and thumbnail_deleted and artifacts_deleted:
                 try:
                     table.delete_item(Key={'id': item_id})
                     file_deleted.append(item_id)
@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In-process BirdNET: the TFLite model is loaded once per container and audio
+# is scored window by window in this process, instead of a
+# `python -m birdnet_analyzer.analyze` subprocess per file that writes a
+# selection table to /tmp for pandas to read back.
+# Keep the copies in every Lambda folder identical.
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from cpu_threads import available_cpus, thread_count
+
+# Source tree of BirdNET-Analyzer, with the model checkpoints (see the Dockerfile)
+BIRDNET_DIR = os.environ.get('BIRDNET_DIR', '/opt/BirdNET-Analyzer')
+
+# Same settings the handlers passed to the CLI
+SENSITIVITY = 0.5
+MIN_CONFIDENCE = 0.25
+SIG_OVERLAP = 0.0  # seconds shared by consecutive 3 s windows
+BANDPASS_FMIN = 0
+BANDPASS_FMAX = 15000
+
+BATCH_SIZE = int(os.environ.get('BIRDNET_BATCH_SIZE', '8'))  # windows per interpreter call
+READ_SECONDS = 600  # audio decoded at a time, so long recordings don't have to fit in memory
+# Windows analyze_batch holds across recordings before it scores them (400 is ~230 MB of 48 kHz float32 windows)
+AUDIO_POOL_MAX_WINDOWS = int(os.environ.get('AUDIO_POOL_MAX_WINDOWS', '400'))
+
+# Saved scores (WindowScores.save) keep what any sensitivity up to MAX_SENSITIVITY
+# could turn into a confidence of at least MIN_STORED_CONFIDENCE
+MAX_SENSITIVITY = 1.5  # top of the CLI's range, [0.5, 1.5]
+MIN_STORED_CONFIDENCE = 0.01
+LOGIT_CLIP = 20.0  # flat_sigmoid clips the shifted logits to [-20, 20]
+STORED_LOGIT_FLOOR = float(np.log(MIN_STORED_CONFIDENCE / (1 - MIN_STORED_CONFIDENCE)) - (MAX_SENSITIVITY - 1.0) * 10.0)
+
+# Activity pre-filter: windows without energy above the noise floor in the bird band skip inference
+AUDIO_ACTIVITY_FILTER = os.environ.get('AUDIO_ACTIVITY_FILTER', 'false').lower() == 'true'
+AUDIO_ACTIVITY_THRESHOLD_DB = float(os.environ.get('AUDIO_ACTIVITY_THRESHOLD_DB', '6'))
+AUDIO_ACTIVITY_VALIDATE = os.environ.get('AUDIO_ACTIVITY_VALIDATE', 'false').lower() == 'true'  # also run unfiltered and compare
+ACTIVITY_BAND = (1000, 10000)  # Hz, where most bird vocalisations are; below is wind and traffic
+ACTIVITY_FRAME = 2048  # STFT frame, ~43 ms at 48 kHz
+NOISE_FLOOR_PERCENTILE = 20  # of the frame levels in a block, the recording's background
+PEAK_PERCENTILE = 95  # of the frame levels in a window, its loudest moments
+
+# Chunk-parallel analysis of long recordings
+AUDIO_CHUNK_SECONDS = float(os.environ.get('AUDIO_CHUNK_SECONDS', '0'))  # 0 analyses every recording in one piece
+AUDIO_CHUNK_WORKERS = int(os.environ.get('AUDIO_CHUNK_WORKERS', str(available_cpus())))
+
+# librosa resamples with numba kernels, compiled on the first decode in a process.
+# The image ships them pre-compiled in NUMBA_IMAGE_CACHE (--warm-cache at build time),
+# but numba only uses a cache directory it can write to, so each container copies
+# them to NUMBA_CACHE_DIR in /tmp once. NUMBA_CPU_NAME=generic in the image keeps
+# the cached code valid on whichever CPU the Lambda runs.
+NUMBA_IMAGE_CACHE = os.environ.get('NUMBA_IMAGE_CACHE', '/opt/numba_cache')
+os.environ.setdefault('NUMBA_CACHE_DIR', '/tmp/numba_cache')
+
+
+def seed_numba_cache(cache_dir=None, image_cache=NUMBA_IMAGE_CACHE):
+    # Fills the writable cache from the image unless this container already has one.
+    # Returns where the cached kernels come from: 'image', 'container' or 'empty' (compiled on first use)
+    cache_dir = cache_dir or os.environ['NUMBA_CACHE_DIR']
+    if os.path.isdir(cache_dir):
+        return 'container'
+    if not image_cache or not os.path.isdir(image_cache) or os.path.abspath(image_cache) == os.path.abspath(cache_dir):
+        return 'empty'
+
+    # Copied under another name first, so a container stopped mid-copy never sees half a cache
+    partial = f"{cache_dir}.{os.getpid()}"
+    shutil.copytree(image_cache, partial)
+    try:
+        os.rename(partial, cache_dir)
+    except OSError:
+        shutil.rmtree(partial, ignore_errors=True)  # another process got there first
+        return 'container'
+    return 'image'
+
+
+NUMBA_CACHE_SOURCE = seed_numba_cache()
+
+
+class WindowScores:
+    """
+    BirdNET output for one recording: start and end second of every analysed
+    window, and a (windows, labels) matrix of the model's logits. Confidences
+    come from the logits for a given sensitivity, so the same scores can be
+    tagged again with other settings without running the model.
+    """
+
+    def __init__(self, starts, ends, logits, labels, skipped=None, sensitivity=SENSITIVITY):
+        self.starts = np.asarray(starts, dtype=np.float32)
+        self.ends = np.asarray(ends, dtype=np.float32)
+        self.logits = np.asarray(logits, dtype=np.float32).reshape(len(self.starts), len(labels))
+        self.labels = labels
+        self.sensitivity = sensitivity
+        # Windows the activity filter kept from the model, their logits are -LOGIT_CLIP
+        self.skipped = np.zeros(len(self.starts), dtype=bool) if skipped is None else np.asarray(skipped, dtype=bool)
+
+    @property
+    def scores(self):
+        return self.confidences()
+
+    def confidences(self, sensitivity=None):
+        return flat_sigmoid(self.logits, self.sensitivity if sensitivity is None else sensitivity)
+
+    def skipped_fraction(self):
+        return float(self.skipped.mean()) if len(self.skipped) else 0.0
+
+    def common_names(self):
+        # Labels are "Scientific name_Common name"
+        return [label.split('_', 1)[-1] for label in self.labels]
+
+    def detections(self, min_confidence=MIN_CONFIDENCE, sensitivity=None):
+        # (start, end, common name, confidence) for every window and species over the threshold
+        names = self.common_names()
+        scores = self.confidences(sensitivity)
+        windows, species = np.nonzero(scores >= min_confidence)
+        return [(float(self.starts[w]), float(self.ends[w]), names[s], float(scores[w, s]))
+                for w, s in zip(windows, species)]
+
+    def species_counts(self, min_confidence=MIN_CONFIDENCE, sensitivity=None, species=None):
+        # Audio tags record presence, so every species found counts once
+        names = self.common_names()
+        found = np.nonzero((self.confidences(sensitivity) >= min_confidence).any(axis=0))[0]
+        return {names[s]: 1 for s in found if species is None or in_species_list(self.labels[s], species)}
+
+    def save(self, f):
+        """
+        Writes the scores as a compressed .npz. Only the logits that could
+        reach MIN_STORED_CONFIDENCE at MAX_SENSITIVITY are kept, as (window,
+        label, logit) triples; the others read back as -LOGIT_CLIP. Tags from
+        a saved file are exact for any min_confidence >= MIN_STORED_CONFIDENCE
+        and sensitivity <= MAX_SENSITIVITY.
+        """
+        windows, labels = np.nonzero(self.logits >= STORED_LOGIT_FLOOR)
+        np.savez_compressed(f, starts=self.starts, ends=self.ends, labels=np.array(self.labels),
+                            skipped=self.skipped, sensitivity=self.sensitivity,
+                            window_index=windows.astype(np.uint32), label_index=labels.astype(np.uint16),
+                            logit=self.logits[windows, labels], logit_floor=STORED_LOGIT_FLOOR)
+
+    @classmethod
+    def load(cls, f):
+        with np.load(f) as data:
+            logits = np.full((len(data['starts']), len(data['labels'])), -LOGIT_CLIP, dtype=np.float32)
+            logits[data['window_index'], data['label_index']] = data['logit']
+            return cls(data['starts'], data['ends'], logits, data['labels'].tolist(), data['skipped'],
+                       float(data['sensitivity']))
+
+    @classmethod
+    def concatenate(cls, parts):
+        # Chunks of one recording, in order
+        return cls(np.concatenate([part.starts for part in parts]),
+                   np.concatenate([part.ends for part in parts]),
+                   np.concatenate([part.logits for part in parts]),
+                   parts[0].labels,
+                   np.concatenate([part.skipped for part in parts]),
+                   parts[0].sensitivity)
+
+
+def flat_sigmoid(logits, sensitivity=SENSITIVITY):
+    # birdnet_analyzer.model.flat_sigmoid(logits, sensitivity=-1, bias=sensitivity), which the CLI applies
+    return (1 / (1.0 + np.exp(-np.clip(logits + (sensitivity - 1.0) * 10.0, -LOGIT_CLIP, LOGIT_CLIP)))).astype(np.float32)
+
+
+def in_species_list(label, species):
+    # species holds labels ("Scientific name_Common name"), scientific or common names
+    scientific, _, common = label.partition('_')
+    return label in species or scientific in species or common in species
+
+
+def rescore(scores_file, min_confidence=MIN_CONFIDENCE, sensitivity=SENSITIVITY, species=None):
+    """
+    Tags from a file written by WindowScores.save() (a path or file object)
+    for another threshold, sensitivity or species list, straight from the
+    stored entries without building the score matrix.
+    """
+    if min_confidence < MIN_STORED_CONFIDENCE or sensitivity > MAX_SENSITIVITY:
+        raise ValueError(f"Stored scores cover min_confidence >= {MIN_STORED_CONFIDENCE} "
+                         f"and sensitivity <= {MAX_SENSITIVITY}")
+
+    with np.load(scores_file) as data:
+        labels = data['labels'].tolist()
+        keep = flat_sigmoid(data['logit'], sensitivity) >= min_confidence
+        found = np.unique(data['label_index'][keep])
+
+    return {labels[s].split('_', 1)[-1]: 1 for s in found if species is None or in_species_list(labels[s], species)}
+
+
+## Activity pre-filter
+def band_levels(windows, rate, band=ACTIVITY_BAND, frame=ACTIVITY_FRAME):
+    # (windows, frames) energy of every half-overlapping STFT frame inside the band, in dB
+    taper = np.hanning(frame).astype(np.float32)
+    freqs = np.fft.rfftfreq(frame, 1 / rate)
+    in_band = (freqs >= band[0]) & (freqs <= band[1])
+
+    levels = []
+    for sig in windows:
+        frames = np.lib.stride_tricks.sliding_window_view(sig, frame)[::frame // 2]
+        power = np.abs(np.fft.rfft(frames * taper, axis=1)[:, in_band]) ** 2
+        levels.append(10 * np.log10(power.sum(axis=1) + 1e-12))
+    return np.array(levels)
+
+
+def active_windows(windows, rate, threshold_db=AUDIO_ACTIVITY_THRESHOLD_DB):
+    """
+    Marks the windows whose loudest in-band frames rise at least threshold_db
+    above the background of the whole block. Silence, wind and steady rain
+    stay at the background level; calls stand out from it.
+    """
+    if not windows:
+        return np.zeros(0, dtype=bool)
+    levels = band_levels(windows, rate)
+    noise_floor = np.percentile(levels, NOISE_FLOOR_PERCENTILE)
+    return np.percentile(levels, PEAK_PERCENTILE, axis=1) >= noise_floor + threshold_db
+
+
+class BirdNETEngine:
+    """
+    Wraps birdnet_analyzer's model and audio helpers. load() imports them and
+    loads the model; analyze() takes a file path, a file-like object or an
+    already decoded mono signal at the model's sample rate and returns the
+    WindowScores.
+    """
+
+    def __init__(self, threads=1, sensitivity=SENSITIVITY, overlap=SIG_OVERLAP, batch_size=BATCH_SIZE,
+                 activity_filter=AUDIO_ACTIVITY_FILTER, activity_threshold_db=AUDIO_ACTIVITY_THRESHOLD_DB):
+        self.threads = threads
+        self.sensitivity = sensitivity
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.activity_filter = activity_filter
+        self.activity_threshold_db = activity_threshold_db
+        self.cfg = None
+        self.first_decode_seconds = None
+
+    def load(self):
+        if self.cfg is not None:
+            return self
+
+        if BIRDNET_DIR not in sys.path:
+            sys.path.insert(0, BIRDNET_DIR)
+        import birdnet_analyzer.config as cfg
+        from birdnet_analyzer import audio, model
+        from birdnet_analyzer.utils import read_lines
+
+        cfg.MODEL_PATH = cfg.BIRDNET_MODEL_PATH
+        cfg.LABELS_FILE = cfg.BIRDNET_LABELS_FILE
+        cfg.SAMPLE_RATE = cfg.BIRDNET_SAMPLE_RATE
+        cfg.SIG_LENGTH = cfg.BIRDNET_SIG_LENGTH
+        cfg.SIG_OVERLAP = self.overlap
+        cfg.TFLITE_THREADS = self.threads
+        cfg.LABELS = read_lines(cfg.LABELS_FILE)
+        model.load_model()
+
+        self.cfg, self.audio, self.model = cfg, audio, model
+        self.labels = list(cfg.LABELS)
+        return self
+
+    @property
+    def sample_rate(self):
+        return self.load().cfg.SAMPLE_RATE
+
+    def decode(self, source, offset=0.0, duration=None):
+        # Mono signal at the model's sample rate, band-limited like the CLI
+        started = time.perf_counter()
+        sig, _ = self.audio.open_audio_file(source, self.sample_rate, offset, duration, BANDPASS_FMIN, BANDPASS_FMAX)
+        if self.first_decode_seconds is None:
+            # Includes compiling or loading the resampler kernels, see seed_numba_cache()
+            self.first_decode_seconds = time.perf_counter() - started
+            print(f"Numba cache: {json.dumps({'source': NUMBA_CACHE_SOURCE, 'first_decode_seconds': round(self.first_decode_seconds, 3)})}")
+        return sig
+
+    def length(self, source):
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        return self.load().audio.get_audio_file_length(source)
+
+    def signal_blocks(self, source, start=0.0, end=None):
+        # (offset in seconds, signal) blocks of at most READ_SECONDS between start and end
+        if isinstance(source, np.ndarray):
+            rate = self.sample_rate
+            yield start, source[int(start * rate):None if end is None else int(end * rate)]
+            return
+
+        length = self.length(source)
+        end = length if end is None else min(end, length)
+        offset = start
+        while offset < end and not np.isclose(offset, end):
+            if hasattr(source, 'seek'):
+                source.seek(0)
+            sig = self.decode(source, offset, min(READ_SECONDS, end - offset))
+            if sig.size == 0:
+                break
+            yield offset, sig
+            offset += READ_SECONDS
+
+    def predict(self, windows):
+        # Logits, batch_size windows per interpreter call; WindowScores applies the sensitivity
+        logits = []
+        for start in range(0, len(windows), self.batch_size):
+            batch = np.array(windows[start:start + self.batch_size], dtype=np.float32)
+            logits.append(np.array(self.model.predict(batch), dtype=np.float32))
+        return np.concatenate(logits) if logits else np.zeros((0, len(self.labels)), dtype=np.float32)
+
+    def block_windows(self, sig, offset):
+        # Windows of one decoded block, their start and end seconds and which of them the model should see
+        cfg = self.cfg
+        step = cfg.SIG_LENGTH - cfg.SIG_OVERLAP
+        windows = self.audio.split_signal(sig, cfg.SAMPLE_RATE, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN)
+        block_seconds = sig.size / cfg.SAMPLE_RATE
+        starts = [offset + i * step for i in range(len(windows))]
+        ends = [offset + min(i * step + cfg.SIG_LENGTH, block_seconds) for i in range(len(windows))]
+
+        if self.activity_filter:
+            active = active_windows(windows, cfg.SAMPLE_RATE, self.activity_threshold_db)
+        else:
+            active = np.ones(len(windows), dtype=bool)
+        return starts, ends, windows, active
+
+    def score_blocks(self, blocks):
+        # Scores the active windows of several (windows, active) blocks in one predict(),
+        # so the interpreter batches fill up across blocks; inactive windows get the lowest logit
+        pooled = [window for windows, active in blocks for window, keep in zip(windows, active) if keep]
+        logits = self.predict(pooled)
+
+        block_scores, used = [], 0
+        for windows, active in blocks:
+            block = np.full((len(windows), len(self.labels)), -LOGIT_CLIP, dtype=np.float32)
+            block[active] = logits[used:used + int(active.sum())]
+            used += int(active.sum())
+            block_scores.append(block)
+        return block_scores
+
+    def window_scores(self, blocks, block_scores):
+        # WindowScores from the (starts, ends, active) of each block and its scores
+        if not blocks:
+            return WindowScores([], [], np.zeros((0, len(self.labels)), dtype=np.float32), self.labels,
+                                sensitivity=self.sensitivity)
+        return WindowScores([s for starts, _, _ in blocks for s in starts],
+                            [e for _, ends, _ in blocks for e in ends],
+                            np.concatenate(block_scores), self.labels,
+                            np.concatenate([~active for _, _, active in blocks]),
+                            self.sensitivity)
+
+    def analyze(self, source, start=0.0, end=None):
+        # start and end (seconds) limit the analysis to part of the recording, see plan_chunks()
+        self.load()
+        blocks, block_scores = [], []
+        for offset, sig in self.signal_blocks(source, start, end):
+            starts, ends, windows, active = self.block_windows(sig, offset)
+            block_scores.extend(self.score_blocks([(windows, active)]))
+            blocks.append((starts, ends, active))
+        return self.window_scores(blocks, block_scores)
+
+    def analyze_batch(self, paths, chunk_runners=None, chunk_seconds=AUDIO_CHUNK_SECONDS,
+                      max_pooled_windows=AUDIO_POOL_MAX_WINDOWS):
+        """
+        Analyses several recordings in one model pass: the windows of every
+        recording that fits in one READ_SECONDS block are pooled into shared
+        interpreter batches, scored whenever the next recording would take the
+        pool past max_pooled_windows. Longer recordings go through
+        analyze_in_chunks(), with chunk_runners[path] if given. Returns
+        {path: WindowScores, or the exception that recording raised}, so one
+        bad file fails only itself.
+        """
+        cfg = self.load().cfg
+        chunk_runners = chunk_runners or {}
+        results, pooled, pooled_windows = {}, [], 0
+
+        for path in paths:
+            try:
+                length = self.length(path)
+                if length > READ_SECONDS or plan_chunks(length, chunk_seconds, cfg.SIG_LENGTH, cfg.SIG_OVERLAP):
+                    results[path] = self.analyze_in_chunks(path, chunk_runners.get(path), chunk_seconds)
+                    continue
+                starts, ends, windows, active = self.block_windows(self.decode(path), 0.0)
+            except Exception as e:
+                results[path] = e
+                continue
+
+            if pooled and pooled_windows + len(windows) > max_pooled_windows:
+                self.score_pooled(pooled, results)
+                pooled, pooled_windows = [], 0
+            pooled.append((path, (starts, ends, active), (windows, active)))
+            pooled_windows += len(windows)
+
+        if pooled:
+            self.score_pooled(pooled, results)
+
+        return {path: results[path] for path in paths}
+
+    def score_pooled(self, pooled, results):
+        # Scores the pooled (path, block, windows) of several recordings into results
+        try:
+            block_scores = self.score_blocks([windows for _, _, windows in pooled])
+        except Exception as e:
+            block_scores = [e] * len(pooled)
+        for (path, block, _), scores in zip(pooled, block_scores):
+            try:
+                if isinstance(scores, Exception):
+                    raise scores
+                results[path] = self.report_activity(path, self.window_scores([block], [scores]))
+            except Exception as e:
+                results[path] = e
+
+    def options(self):
+        # Settings a worker process needs to analyse the same way as this engine
+        return {'sensitivity': self.sensitivity, 'overlap': self.overlap, 'batch_size': self.batch_size,
+                'activity_filter': self.activity_filter, 'activity_threshold_db': self.activity_threshold_db}
+
+    def analyze_in_chunks(self, path, chunk_runner=None, chunk_seconds=AUDIO_CHUNK_SECONDS):
+        # Recordings longer than chunk_seconds are split with plan_chunks() and analysed in parallel,
+        # by chunk_runner(path, chunks) or by local worker processes
+        cfg = self.load().cfg
+        chunks = plan_chunks(self.length(path), chunk_seconds, cfg.SIG_LENGTH, cfg.SIG_OVERLAP)
+        if chunks and chunk_runner:
+            scores = WindowScores.concatenate(chunk_runner(path, chunks))
+        elif chunks:
+            scores = WindowScores.concatenate(run_chunks_in_processes(path, chunks, options=self.options()))
+        else:
+            scores = self.analyze(path)
+        return self.report_activity(path, scores)
+
+    def report_activity(self, path, scores):
+        # Logs what the activity filter skipped; in validation mode returns the unfiltered scores
+        if self.activity_filter:
+            print(f"Activity filter skipped {scores.skipped_fraction():.1%} of {len(scores.starts)} windows in {os.path.basename(path)}")
+            if AUDIO_ACTIVITY_VALIDATE:
+                return self.validate_activity_filter(path, scores)[1]
+        return scores
+
+    def validate_activity_filter(self, path, filtered):
+        # Runs the recording again without the filter and reports the species the filter lost.
+        # Returns the report and the unfiltered scores, so tags stay complete while the threshold is tuned.
+        started = time.perf_counter()
+        self.activity_filter = False
+        try:
+            full = self.analyze(path)
+        finally:
+            self.activity_filter = True
+
+        filtered_species, full_species = set(filtered.species_counts()), set(full.species_counts())
+        report = {
+            'file': os.path.basename(path),
+            'threshold_db': self.activity_threshold_db,
+            'skipped_fraction': round(filtered.skipped_fraction(), 4),
+            'missed_species': sorted(full_species - filtered_species),
+            'extra_species': sorted(filtered_species - full_species),
+            'full_run_seconds': round(time.perf_counter() - started, 2),
+        }
+        print(f"Activity filter validation: {json.dumps(report)}")
+        return report, full
+
+
+## Chunk-parallel
+def plan_chunks(length, chunk_seconds, sig_length, overlap=SIG_OVERLAP):
+    """
+    Splits a recording into [start, end) ranges of about chunk_seconds that
+    start on the window grid of a full run, so the chunks together analyse
+    exactly the windows the full run would. Consecutive ranges overlap by the
+    window overlap, which the last window of a chunk shares with the first
+    window of the next. Returns [] when one chunk would cover the recording.
+    """
+    if not chunk_seconds or length <= chunk_seconds:
+        return []
+
+    step = sig_length - overlap
+    span = max(1, int(chunk_seconds // step)) * step
+
+    chunks = []
+    start = 0.0
+    while start < length and not np.isclose(start, length):
+        chunks.append({'start': start, 'end': start + span + overlap})
+        start += span
+    chunks[-1]['end'] = None
+    return chunks
+
+
+def chunk_worker(conn, path, chunk, threads, options):
+    try:
+        scores = BirdNETEngine(threads=threads, **options).analyze(path, **chunk)
+        conn.send(('ok', (scores.starts, scores.ends, scores.logits, scores.labels, scores.skipped, scores.sensitivity)))
+    except Exception as e:
+        conn.send(('error', str(e)))
+    finally:
+        conn.close()
+
+
+def run_chunks_in_processes(path, chunks, workers=AUDIO_CHUNK_WORKERS, options=None):
+    # Lambda has no /dev/shm, so use plain processes and pipes rather than a Pool.
+    # Spawned (not forked) workers, because TensorFlow's thread pools don't survive a fork.
+    ctx = multiprocessing.get_context('spawn')
+    threads = thread_count(min(workers, len(chunks)))  # split the CPUs between concurrent workers
+    results = []
+
+    for wave in range(0, len(chunks), workers):
+        running = []
+        for chunk in chunks[wave:wave + workers]:
+            parent_conn, child_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=chunk_worker, args=(child_conn, path, chunk, threads, options or {}))
+            process.start()
+            child_conn.close()
+            running.append((process, parent_conn))
+
+        for process, parent_conn in running:
+            try:
+                status, result = parent_conn.recv()
+            except EOFError:
+                process.join()
+                status, result = 'error', f"worker exited with code {process.exitcode}"
+            process.join()
+            if status != 'ok':
+                raise Exception(f"Chunk worker failed: {result}")
+            results.append(WindowScores(*result))
+
+    return results
+
+
+## Numba cache build and measurement
+# python birdnet_engine.py --warm-cache     compiles the kernels into NUMBA_CACHE_DIR (image build step)
+# python birdnet_engine.py --measure-cache  first-decode time in fresh processes, with and without the image's cache
+def write_sample(path, seconds=3, rate=44100):
+    # Noise at a rate other than the model's, so decoding goes through the resampler
+    import soundfile as sf
+    sf.write(path, np.random.default_rng(0).normal(0, 0.1, seconds * rate).astype(np.float32), rate)
+    return path
+
+
+def time_decodes(path):
+    # Seconds for the first decode in this process, which compiles or loads the kernels, and a second one
+    if BIRDNET_DIR not in sys.path:
+        sys.path.insert(0, BIRDNET_DIR)
+    import birdnet_analyzer.config as cfg
+    from birdnet_analyzer import audio
+
+    timings = []
+    for _ in range(2):
+        started = time.perf_counter()
+        audio.open_audio_file(path, cfg.BIRDNET_SAMPLE_RATE, 0, None, BANDPASS_FMIN, BANDPASS_FMAX)
+        timings.append(time.perf_counter() - started)
+    return {'source': NUMBA_CACHE_SOURCE, 'first_decode_seconds': round(timings[0], 3),
+            'second_decode_seconds': round(timings[1], 3)}
+
+
+def measure_numba_cache(sample, repeat=3):
+    if not os.path.isdir(NUMBA_IMAGE_CACHE):
+        raise Exception(f"No pre-compiled cache in {NUMBA_IMAGE_CACHE}, build it with --warm-cache first")
+
+    report = {}
+    for mode, image_cache in [('empty', ''), ('image', NUMBA_IMAGE_CACHE)]:
+        runs = []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as tmp:
+                env = dict(os.environ, NUMBA_CACHE_DIR=os.path.join(tmp, 'numba_cache'), NUMBA_IMAGE_CACHE=image_cache)
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), '--time-decode', sample],
+                                        env=env, capture_output=True, text=True, check=True).stdout
+                runs.append(json.loads(output.strip().splitlines()[-1]))
+        report[mode] = {'first_decode_seconds': [run['first_decode_seconds'] for run in runs],
+                        'median': statistics.median(run['first_decode_seconds'] for run in runs)}
+
+    report['compile_seconds_saved'] = round(report['empty']['median'] - report['image']['median'], 3)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or measure the numba cache of the audio decoder")
+    parser.add_argument('--warm-cache', action='store_true')
+    parser.add_argument('--measure-cache', action='store_true')
+    parser.add_argument('--time-decode', default=None, metavar='AUDIO_FILE', help=argparse.SUPPRESS)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.time_decode:
+        print(json.dumps(time_decodes(args.time_decode)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = write_sample(os.path.join(tmp, 'sample.wav'))
+        if args.warm_cache:
+            timings = time_decodes(sample)
+            print(json.dumps({'cache_dir': os.environ['NUMBA_CACHE_DIR'],
+                              'compile_seconds': round(timings['first_decode_seconds'] - timings['second_decode_seconds'], 3)}))
+        elif args.measure_cache:
+            print(json.dumps(measure_numba_cache(sample, args.repeat), indent=2))
+        else:
+            parser.error("nothing to do, pass --warm-cache or --measure-cache")
+
+
+if __name__ == '__main__':
+    main()
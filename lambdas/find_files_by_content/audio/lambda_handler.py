@@ -1,8 +1,11 @@
 import os
 import json
 import boto3
-import subprocess
-import pandas as pd
+from s3_download import download
+from workspace import workspace
+from cpu_threads import configure_threads
+from birdnet_engine import BirdNETEngine
+from content_cache import sha256_file, lookup
 from urllib.parse import urlparse
 from decimal import Decimal
 from boto3.dynamodb.conditions import Key
@@ -17,8 +20,23 @@ query_table = dynamodb.Table(query_table_name)
 results_table_name = 'birdtag_query_job_results'
 results_table = dynamodb.Table(results_table_name)
 
+# BirdNET gets one thread per vCPU the function's memory setting provides
+BIRDNET_THREADS = configure_threads()['threads']
+
+# Loaded once per container, during the Lambda init phase unless WARM_START is off
+engine = BirdNETEngine(threads=BIRDNET_THREADS)
+if os.environ.get('WARM_START', 'true').lower() == 'true':
+    try:
+        engine.load()
+    except Exception as e:
+        print(f"Warm start failed, the model will load on first use: {e}")
+
 
 def lambda_handler(event, context):
+    # Scratch space for this invocation, removed when it ends
+    job_dir = workspace.allocate(context.aws_request_id if context else None)
+
+    job_id = None
     try:
         for record in event['Records']:
 
@@ -31,7 +49,7 @@ def lambda_handler(event, context):
             parts = object_key.split('/')
             user_id = parts[1]
             filename = parts[2]
-            tmp_audio_path = f"/tmp/{filename}"
+            tmp_audio_path = os.path.join(job_dir, filename)
             
             job_id, ext = os.path.splitext(filename)
             ext = ext.lower()
@@ -53,53 +71,21 @@ def lambda_handler(event, context):
                 print(f"Unsupported file type: {ext}")
                 continue
 
-            # Download audio file to /tmp/
-            s3_client.download_file(bucket_name, object_key, tmp_audio_path)
-
-            env = os.environ.copy()
-            env["NUMBA_CACHE_DIR"] = "/tmp/numba_cache"
-            env["NUMBA_DISABLE_CACHE"] = "1"
-            env["TMPDIR"] = "/tmp"
-            env["TEMP"] = "/tmp"
-            
-            # Run BirdNET CLI
-            output_dir = "/tmp"
-            # os.chdir('/Users/miranda/Monash/FIT5225/BirdNET-Analyzer') #local test only
-            os.chdir('/opt/BirdNET-Analyzer')
-            command = [
-                "python3", "-m", "birdnet_analyzer.analyze",
-                tmp_audio_path,
-                "--output", output_dir,
-                "--rtype", "table",
-                "--sensitivity", "0.5",
-                "--threads", "1"
-            ]
-
-            try:
-                subprocess.run(command, check=True, env=env)
-            except subprocess.CalledProcessError as e:
-                print("BirdNET Analyzer failed:", e)
-                return {"statusCode": 500, "body": "Detection failed"}
-            
-            base_name = os.path.splitext(filename)[0]
-            result_file_path = os.path.join(output_dir, f"{base_name}.BirdNET.selection.table.txt")
-            if not os.path.exists(result_file_path):
-                print(f"No result file generated for {filename}")
-                job_status = 'COMPLETED' 
-                results_table.update_item(
-                    Key={'job_id': job_id},
-                    UpdateExpression="SET job_status = :s, discovered_tags = :dt, search_results_payload = :p",
-                    ExpressionAttributeValues={
-                        ':s': job_status,
-                        ':dt': {},
-                        ':p': json.dumps({"results": []})
-                    }
-                )                
-                continue
-
-            df = pd.read_csv(result_file_path, sep="\t")
-
-            if df.empty:
+            # Download audio file to the job directory with parallel ranged GETs
+            download(s3_client, bucket_name, object_key, tmp_audio_path)
+
+            # A query recording with the same bytes as an already processed file reuses its tags.
+            # Queries only read the cache: a row written here would have no window scores, and an
+            # upload with these bytes reusing it would never get its own
+            digest = sha256_file(tmp_audio_path)
+            cached = lookup(digest)
+            if cached:
+                print(f"{filename} has the same content as an already processed file, reusing its tags")
+                species_counts = cached['tags']
+            else:
+                species_counts = engine.analyze_in_chunks(tmp_audio_path).species_counts()
+
+            if not species_counts:
                 print(f"No birds detected in {filename}")
                 job_status = 'COMPLETED' 
                 results_table.update_item(
@@ -113,8 +99,6 @@ def lambda_handler(event, context):
                 )                
                 continue
 
-            species_list = df['Common Name'].unique().tolist()
-            species_counts = {species: 1 for species in species_list}
             print(f"Species detected in {filename}:", species_counts)
 
             # Load response from dynamo db
@@ -192,10 +176,19 @@ def lambda_handler(event, context):
     
     except Exception as e:
         print(f'Error: {e}')
+        if job_id:
+            # A failed detection leaves no partial tags behind, only the job's failure
+            results_table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression="SET job_status = :s",
+                ExpressionAttributeValues={':s': 'FAILED'}
+            )
         return {
             "statusCode": 500,
             "body": json.dumps(f"Error: {str(e)}")
         }
+    finally:
+        workspace.release(job_dir)
 
 
 def decimal_default(obj): 
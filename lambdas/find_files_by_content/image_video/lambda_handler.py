@@ -3,7 +3,9 @@ import boto3
 import os
 from decimal import Decimal
 from boto3.dynamodb.conditions import Key
-from bird_detection import image_prediction, video_prediction
+from bird_detection import image_prediction, video_prediction, warm_start, decode_image, video_source
+from workspace import workspace
+from content_cache import sha256_bytes, sha256_object, lookup
 from urllib.parse import urlparse
 import datetime
 
@@ -15,6 +17,13 @@ query_table = dynamodb.Table(query_table_name)
 results_table_name = 'birdtag_query_job_results'
 results_table = dynamodb.Table(results_table_name)
 
+# Load and warm up the model during the Lambda init phase instead of on the first request
+if os.environ.get('WARM_START', 'true').lower() == 'true':
+    try:
+        warm_start()
+    except Exception as e:
+        print(f"Warm start failed, the model will load on first use: {e}")
+
 
 def decimal_default(obj): 
     if isinstance(obj, Decimal): return int(obj) if obj % 1 == 0 else float(obj)
@@ -67,6 +76,10 @@ def generate_presigned_get_url(s3_object_url_from_db):
         return None
 
 def lambda_handler(event, context):
+    # Scratch space for this invocation, removed when it ends
+    job_dir = workspace.allocate(context.aws_request_id if context else None)
+
+    job_id = None
     try:
         for record in event['Records']:
             bucket_name = record['s3']['bucket']['name']
@@ -99,22 +112,29 @@ def lambda_handler(event, context):
             )
 
 
-            # Download the image from S3
-            response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-            tmp_path = f"/tmp/{filename}"
-            with open(tmp_path, 'wb') as f:
-                f.write(response['Body'].read())
+            # Only used if the video can't be streamed from S3
+            tmp_path = os.path.join(job_dir, filename)
 
             # Check the file is image or video
+            # A query file with the same bytes as an already processed file reuses its tags.
+            # Queries only read the cache: a row written here would have no raw detections, and an
+            # upload with these bytes reusing it would never get its own
             if ext in ['.jpg', '.jpeg', '.png']:
-                species_counts = image_prediction(tmp_path)
+                # Decode the image straight from the S3 bytes
+                data = s3_client.get_object(Bucket=bucket_name, Key=object_key)['Body'].read()
+                cached = lookup(sha256_bytes(data))
+                species_counts = cached['tags'] if cached else image_prediction(decode_image(data))
 
             elif ext in ['.mp4', '.mov']:
-                species_counts = video_prediction(tmp_path)
+                cached = lookup(sha256_object(s3_client, bucket_name, object_key))
+                species_counts = cached['tags'] if cached else video_prediction(video_source(bucket_name, object_key, tmp_path))
 
             else:
                 raise ValueError(f"Unsupported file type: {ext}")
 
+            if cached:
+                print(f"{filename} has the same content as an already processed file, reusing its tags")
+
             if isinstance(species_counts, str):
                 species_counts = json.loads(species_counts)
                 print(f"Detected species for {filename}: {species_counts}")
@@ -204,7 +224,8 @@ def lambda_handler(event, context):
             print(f"Deleted input file from S3: s3://{bucket_name}/{object_key}")
 
             try:
-                os.remove(tmp_path)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
             except Exception as e:
                 print(f"Failed to delete local tmp file: {e}")            
 
@@ -219,8 +240,16 @@ def lambda_handler(event, context):
     
     except Exception as e:
         print(f'Error: {e}')
+        if job_id:
+            # A failed detection leaves no partial tags behind, only the job's failure
+            results_table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression="SET job_status = :s",
+                ExpressionAttributeValues={':s': 'FAILED'}
+            )
         return {
             "statusCode": 500,
             "body": json.dumps(f"Error: {str(e)}")
         }
-
+    finally:
+        workspace.release(job_dir)